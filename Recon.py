@@ -4,8 +4,19 @@ from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
 from dotenv import load_dotenv
+import hashlib
+import json
 import os
+import random
+import re
+import sqlite3
 import time
+from typing import Awaitable, Callable, List, NamedTuple, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -17,8 +28,47 @@ API_KEY = os.getenv("OPENAI_API_KEY")
 if not API_KEY:
     raise ValueError("OPENAI_API_KEY not found. Please set it in your .env file.")
 
+MODEL_NAME = "gpt-4o"
+TEMPERATURE = 0.0
+# Categories of already classified comments are kept here and reused across runs.
+CACHE_PATH = "recon_cache.sqlite"
+# Batches are packed up to this many prompt tokens of emails, and at most this many emails
+# (each needs a line in the answer, which has its own, smaller limit).
+MAX_BATCH_TOKENS = 8000
+MAX_BATCH_EMAILS = 150
+# Emails missing from the answers are sent again, in new batches, up to this many times.
+MAX_REQUERY_ROUNDS = 2
+CATEGORIES = ["Sales Inquiry", "Customer Support", "Technical Issue", "Spam", "Other"]
+
+# API budgets of the account's tier; calls are paced to stay within both.
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 30000
+OUTPUT_TOKENS_PER_EMAIL = 15  # Expected answer tokens per email, counted against the token budget
+# Batches in flight start at INITIAL_CONCURRENCY and grow while calls answer within
+# TARGET_LATENCY_SECONDS; rate-limit and server errors halve the window.
+INITIAL_CONCURRENCY = 2
+MAX_CONCURRENCY = 16
+TARGET_LATENCY_SECONDS = 60
+MAX_RETRIES = 5
+# The comments of each category are summarized in groups of up to this many tokens, and the
+# partial summaries merged this many at a time, round after round, into the final summary.
+SUMMARY_GROUP_TOKENS = 6000
+SUMMARY_MERGE_FAN_IN = 8
+SUMMARY_SAMPLE_PER_CATEGORY = 500  # Comments per category read for the topics; counts use all emails
+
 # Initialize the LLM
-llm = ChatOpenAI(temperature=0.0, model_name="gpt-4o", openai_api_key=API_KEY)
+# Retries are left to RequestScheduler, which knows about the rate budgets.
+llm = ChatOpenAI(temperature=TEMPERATURE, model_name=MODEL_NAME, openai_api_key=API_KEY, max_retries=0)
+
+# Local tokenizer for batch sizing; without tiktoken, ~4 characters per token is assumed.
+if tiktoken is not None:
+    try:
+        _encoding = tiktoken.encoding_for_model(MODEL_NAME)
+    except KeyError:
+        _encoding = tiktoken.get_encoding("o200k_base")
+else:
+    print("Warning: tiktoken is not installed, estimating token counts from text length.")
+    _encoding = None
 
 # --- Prompts ---
 # Prompt for classifying a batch of emails
@@ -40,50 +90,359 @@ review_prompt = PromptTemplate(
     """
 )
 
-# Prompt for summarizing the reviews
+# Prompt for summarizing the emails of one category
 summary_prompt = PromptTemplate(
-    input_variables=["reviews"],
+    input_variables=["category", "emails", "distribution"],
     template="""
-    You are a reporting analyst. Please summarize the following email classifications.
-    Provide a high-level overview of the topics discussed and their distribution.
+    You are a reporting analyst. The following emails were all classified as {category}.
+    Provide a high-level overview of the topics they discuss.
 
-    Classifications:
-    {reviews}
+    Emails:
+    {emails}
+
+    The exact category distribution over all emails is given below; use these counts as they are.
+    {distribution}
 
     Your summary should be concise and informative.
     """
 )
 
+# Prompt for merging partial summaries of the classifications
+merge_prompt = PromptTemplate(
+    input_variables=["summaries", "distribution"],
+    template="""
+    You are a reporting analyst. The following are summaries of the topics of groups of classified emails, each headed by its category.
+    Merge them into a single high-level overview of the topics discussed and their distribution.
+
+    Partial summaries:
+    {summaries}
+
+    The exact category distribution over all emails is given below; use these counts as they are.
+    {distribution}
+
+    Your summary should be concise and informative.
+    """
+)
+
+# An answer line such as "[Email 12]: [Spam]", "Email 12: Spam" or "3. [Email 12]: Spam"
+CLASSIFICATION_LINE = re.compile(
+    r"^\s*(?:\d+[.)]\s*)?\W*Email\s*(\d+)\W*?:\s*\[?(.*?)\]?\W*$", re.IGNORECASE | re.MULTILINE
+)
+# A known category at the start of an answer, optionally followed by an explanation
+# ("Sales Inquiry - asks about pricing")
+CATEGORY_PREFIX = r"^\W*(" + "|".join(re.escape(category) for category in CATEGORIES) + r")\b"
+
 # --- Core Functions ---
 
-async def process_batch(batch_content: str, chain: LLMChain) -> str:
+class EmailBatch(NamedTuple):
+    """A classification prompt's worth of emails and the ids they are numbered with."""
+    email_ids: List[int]
+    content: str
+    tokens: int
+
+def count_tokens(text: str) -> int:
+    """Counts (or estimates) the tokens of a text."""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def build_batches(entries: pd.Series, max_tokens: int = MAX_BATCH_TOKENS,
+                  max_emails: int = MAX_BATCH_EMAILS) -> List[EmailBatch]:
+    """
+    Packs "[Email N]: ..." entries, indexed by email id, into batches under a token budget.
+
+    Entries keep their order and id, so every id appears in exactly one batch. An entry
+    larger than the budget on its own gets a batch to itself.
+    """
+    batches = []
+    ids, lines, tokens = [], [], 0
+    for email_id, entry in entries.items():
+        entry_tokens = count_tokens(entry) + 1  # + the newline joining it to the batch
+        if lines and (tokens + entry_tokens > max_tokens or len(lines) >= max_emails):
+            batches.append(EmailBatch(ids, "\n".join(lines), tokens))
+            ids, lines, tokens = [], [], 0
+        if entry_tokens > max_tokens:
+            print(f"Warning: Email {email_id} alone is about {entry_tokens} tokens, over the batch budget.")
+        ids.append(email_id)
+        lines.append(entry)
+        tokens += entry_tokens
+    if lines:
+        batches.append(EmailBatch(ids, "\n".join(lines), tokens))
+    return batches
+
+def parse_classifications(review: str, email_ids: List[int]) -> pd.DataFrame:
+    """
+    Extracts one (email_id, Category) row per email of the batch from its answer.
+
+    Only answers starting with one of CATEGORIES count; emails answered with anything
+    else are left out, so they are re-queried like emails the answer skipped.
+    """
+    rows = pd.DataFrame(CLASSIFICATION_LINE.findall(review), columns=["email_id", "Category"])
+    rows["email_id"] = rows["email_id"].astype(int)
+    canonical = {category.lower(): category for category in CATEGORIES}
+    rows["Category"] = rows["Category"].str.extract(CATEGORY_PREFIX, flags=re.IGNORECASE)[0].str.lower().map(canonical)
+    return rows[rows["email_id"].isin(email_ids) & rows["Category"].notna()].drop_duplicates("email_id")
+
+def classification_keys(comments: pd.Series) -> pd.Series:
+    """
+    Hashes each comment together with the model, temperature and prompt template.
+
+    With temperature 0 the same inputs give the same category, so a key identifies a
+    classification that can be reused; changing any of them invalidates the cache.
+    """
+    prefix = json.dumps([MODEL_NAME, TEMPERATURE, review_prompt.template])
+    return comments.map(lambda comment: hashlib.sha256(f"{prefix}\x00{comment}".encode("utf-8")).hexdigest())
+
+def open_cache(path: str = CACHE_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS classifications (key TEXT PRIMARY KEY, category TEXT)")
+    return conn
+
+def cached_categories(conn: sqlite3.Connection, keys: pd.Series) -> pd.Series:
+    """Returns the cached category of each key (NaN when not cached or not in CATEGORIES), aligned with keys."""
+    found = {}
+    unique_keys = keys.unique().tolist()
+    for start in range(0, len(unique_keys), 900):
+        chunk = unique_keys[start:start + 900]
+        placeholders = ",".join("?" * len(chunk))
+        found.update(conn.execute(f"SELECT key, category FROM classifications WHERE key IN ({placeholders})", chunk))
+    return keys.map(found).where(lambda categories: categories.isin(CATEGORIES))
+
+def store_categories(conn: sqlite3.Connection, keys: pd.Series, categories: pd.Series):
+    """Caches the categories of the given keys; categories outside CATEGORIES are not stored."""
+    valid = categories.isin(CATEGORIES).tolist()
+    conn.executemany(
+        "INSERT OR REPLACE INTO classifications (key, category) VALUES (?, ?)",
+        ((key, category) for key, category, is_valid in zip(keys.tolist(), categories.tolist(), valid) if is_valid)
+    )
+    conn.commit()
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Returns how long to wait before retrying a failed call, or None if it should not be retried.
+
+    Rate-limit (429) and server (5xx) errors, timeouts and connection errors are retried;
+    a Retry-After header sent with the error is honoured, otherwise 0 is returned.
+    """
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    retryable = (
+        status == 429 or (isinstance(status, int) and status >= 500)
+        or isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError))
+        or type(error).__name__ in ("APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError")
+    )
+    if not retryable:
+        return None
+    try:
+        return max(0.0, float(getattr(response, "headers", {}).get("retry-after")))
+    except (TypeError, ValueError):
+        return 0.0
+
+class RequestScheduler:
+    """
+    Runs LLM calls within requests- and tokens-per-minute budgets and an adaptive concurrency window.
+
+    Both budgets refill continuously, and callers wait in arrival order until theirs covers
+    the call. The window grows by about one call per window of calls answered within the
+    target latency, and is halved (at most every few seconds) when calls fail with a
+    retryable error; those are retried with jittered exponential backoff.
+    """
+    def __init__(self, requests_per_minute: int = REQUESTS_PER_MINUTE, tokens_per_minute: int = TOKENS_PER_MINUTE,
+                 initial: int = INITIAL_CONCURRENCY, maximum: int = MAX_CONCURRENCY,
+                 target_latency: float = TARGET_LATENCY_SECONDS, max_retries: int = MAX_RETRIES):
+        self._requests_per_minute = requests_per_minute
+        self._tokens_per_minute = tokens_per_minute
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._budget_lock = asyncio.Lock()
+        self._maximum = max(1, maximum)
+        self.limit = float(min(max(1, initial), self._maximum))
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._target_latency = target_latency
+        self._max_retries = max_retries
+        self._condition = asyncio.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self._refilled_at = now - self._refilled_at, now
+        self._request_allowance = min(self._requests_per_minute, self._request_allowance + elapsed * self._requests_per_minute / 60)
+        self._token_allowance = min(self._tokens_per_minute, self._token_allowance + elapsed * self._tokens_per_minute / 60)
+
+    async def _reserve(self, tokens: int):
+        """Waits until both budgets cover the call, then takes it out of them."""
+        tokens = min(tokens, self._tokens_per_minute)  # a call larger than the budget waits for a full minute's worth
+        async with self._budget_lock:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                self._refill()
+                if self._request_allowance >= 1 and self._token_allowance >= tokens:
+                    self._request_allowance -= 1
+                    self._token_allowance -= tokens
+                    return
+                await asyncio.sleep(max(
+                    (1 - self._request_allowance) * 60 / self._requests_per_minute,
+                    (tokens - self._token_allowance) * 60 / self._tokens_per_minute,
+                    0.01
+                ))
+
+    async def _acquire_slot(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+
+    async def _release_slot(self, latency: Optional[float], overloaded: bool):
+        async with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                if now - self._last_decrease >= 5:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_decrease = now
+            elif latency is not None and latency <= self._target_latency:
+                self.limit = min(self._maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    async def run(self, call: Callable[[], Awaitable], tokens: int):
+        """Awaits call() once budgets and window allow, retrying retryable errors; raises the last error."""
+        for attempt in range(self._max_retries + 1):
+            await self._acquire_slot()
+            latency, overloaded = None, False
+            try:
+                await self._reserve(tokens)
+                started = time.monotonic()
+                result = await call()
+                latency = time.monotonic() - started
+                return result
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None or attempt == self._max_retries:
+                    raise
+                overloaded = True
+                if wait:
+                    self._paused_until = max(self._paused_until, time.monotonic() + wait)
+                else:
+                    wait = random.uniform(0, min(60, 2 ** attempt))
+                print(f"Retrying a batch in {wait:.1f}s after {type(e).__name__}: {e}")
+            finally:
+                await self._release_slot(latency, overloaded)
+            await asyncio.sleep(wait)
+
+async def process_batch(batch: EmailBatch, chain: LLMChain, scheduler: RequestScheduler) -> str:
     """Sends a single batch of emails to the LLM for review."""
+    tokens = batch.tokens + count_tokens(review_prompt.template) + OUTPUT_TOKENS_PER_EMAIL * len(batch.email_ids)
     try:
-        response = await chain.ainvoke({"emails": batch_content})
+        response = await scheduler.run(lambda: chain.ainvoke({"emails": batch.content}), tokens)
         return response['text']
     except Exception as e:
+        print(f"Error processing batch of emails {batch.email_ids[0]}-{batch.email_ids[-1]}: {e}")
         return f"Error processing batch: {e}"
 
-async def run_concurrent_reviews(email_batches: list, chain: LLMChain) -> list:
-    """Processes email batches concurrently with a concurrency limit of 2."""
-    semaphore = asyncio.Semaphore(2)  # Limit to 2 concurrent requests
-    tasks = []
-
-    async def task_wrapper(batch):
-        async with semaphore:
-            return await process_batch(batch, chain)
+async def run_concurrent_reviews(email_batches: List[EmailBatch], chain: LLMChain, scheduler: RequestScheduler,
+                                 on_answer: Optional[Callable[[EmailBatch, str], None]] = None) -> list:
+    """Processes email batches concurrently, paced by the scheduler; on_answer gets each answer as it arrives."""
+    async def review(batch: EmailBatch) -> str:
+        answer = await process_batch(batch, chain, scheduler)
+        if on_answer:
+            on_answer(batch, answer)
+        return answer
 
-    for batch in email_batches:
-        tasks.append(task_wrapper(batch))
-    
+    tasks = [review(batch) for batch in email_batches]
     results = await asyncio.gather(*tasks)
     return results
 
-def summarize_reviews(all_reviews: str, chain: LLMChain) -> str:
-    """Summarizes all the generated LLM reviews."""
+async def classify_emails(entries: pd.Series, chain: LLMChain, scheduler: RequestScheduler,
+                          on_classified: Optional[Callable[[pd.DataFrame], None]] = None
+                          ) -> Tuple[pd.DataFrame, List[str], List[int]]:
+    """
+    Classifies "[Email N]: ..." entries indexed by email id.
+
+    Returns the (email_id, Category) table, the raw answers, and the ids still missing
+    after re-querying the emails the answers left out (or whose batch failed).
+    on_classified gets each batch's parsed rows as soon as its answer arrives.
+    """
+    classifications = [pd.DataFrame({"email_id": pd.Series(dtype=int), "Category": pd.Series(dtype=str)})]
+    reviews = []
+    pending = entries
+    for round_number in range(MAX_REQUERY_ROUNDS + 1):
+        if pending.empty:
+            break
+        if round_number:
+            print(f"Re-querying {len(pending)} emails missing from the answers...")
+        batches = build_batches(pending)
+
+        def on_answer(batch: EmailBatch, answer: str):
+            rows = parse_classifications(answer, batch.email_ids)
+            classifications.append(rows)
+            if on_classified:
+                on_classified(rows)
+
+        reviews += await run_concurrent_reviews(batches, chain, scheduler, on_answer)
+        classified = pd.concat(classifications, ignore_index=True)["email_id"]
+        pending = pending[~pending.index.isin(classified)]
+    return pd.concat(classifications, ignore_index=True), reviews, pending.index.tolist()
+
+def category_distribution(classifications: pd.DataFrame, total_emails: int) -> str:
+    """Counts the emails per category locally, as lines the summary prompts can quote."""
+    counts = classifications['Category'].value_counts()
+    unclassified = total_emails - counts.sum()
+    if unclassified:
+        counts["Unclassified"] = unclassified
+    return "\n".join(
+        f"- {category}: {count} emails ({count / total_emails:.1%})" for category, count in counts.items()
+    )
+
+async def summarize_reviews(classifications: pd.DataFrame, entries: pd.Series, total_emails: int,
+                            scheduler: RequestScheduler) -> str:
+    """
+    Summarizes the topics of the classified emails with a tree of concurrent LLM calls.
+
+    The "[Email N]: ..." entries (indexed by email id) of each category, at most
+    SUMMARY_SAMPLE_PER_CATEGORY of them, are summarized concurrently in groups that fit
+    SUMMARY_GROUP_TOKENS. The partial summaries are then merged SUMMARY_MERGE_FAN_IN at a
+    time until one is left, so the size of the dataset is not limited by the model context.
+    The category counts are computed locally and passed to every call, so the model only
+    narrates them.
+    """
+    if classifications.empty:
+        return "No classifications to summarize."
+    distribution = category_distribution(classifications, total_emails)
+    summary_chain = LLMChain(llm=llm, prompt=summary_prompt)
+    merge_chain = LLMChain(llm=llm, prompt=merge_prompt)
+
+    async def summarize(chain: LLMChain, inputs: dict, content_tokens: int) -> str:
+        tokens = content_tokens + count_tokens(chain.prompt.template) + count_tokens(distribution) + 1000
+        response = await scheduler.run(lambda: chain.ainvoke(inputs), tokens)
+        return response['text']
+
+    async def summarize_category(category: str, group: EmailBatch) -> str:
+        summary = await summarize(
+            summary_chain, {"category": category, "emails": group.content, "distribution": distribution}, group.tokens
+        )
+        return f"{category}:\n{summary}"
+
     try:
-        summary = chain.run(all_reviews)
-        return summary
+        tasks = []
+        for category, email_ids in classifications.groupby('Category')['email_id']:
+            sample = email_ids.sample(min(len(email_ids), SUMMARY_SAMPLE_PER_CATEGORY), random_state=0).sort_values()
+            for group in build_batches(entries.loc[sample], SUMMARY_GROUP_TOKENS, max_emails=len(sample)):
+                tasks.append(summarize_category(category, group))
+        partials = await asyncio.gather(*tasks)
+        while len(partials) > 1:
+            print(f"Merging {len(partials)} partial summaries...")
+            fan_in = max(2, SUMMARY_MERGE_FAN_IN)
+            groups = [partials[i:i + fan_in] for i in range(0, len(partials), fan_in)]
+            partials = await asyncio.gather(*(
+                summarize(merge_chain, {"summaries": "\n\n".join(group), "distribution": distribution},
+                          sum(count_tokens(summary) for summary in group))
+                for group in groups
+            ))
+        return partials[0]
     except Exception as e:
         return f"Error generating summary: {e}"
 
@@ -105,35 +464,45 @@ async def main():
         return
 
     # 2. Add a unique Email ID to each comment
-    df['email_id_comment'] = df.apply(lambda row: f"[Email {row.name + 1}]: {row['comment']}", axis=1)
+    df['email_id'] = range(1, len(df) + 1)
+    df['email_id_comment'] = "[Email " + df['email_id'].astype(str) + "]: " + df['comment'].astype(str).fillna("nan")
 
-    # 3. Concatenate every 100 emails
-    batch_size = 100
-    email_batches = [
-        "\n".join(df['email_id_comment'][i:i + batch_size])
-        for i in range(0, len(df), batch_size)
-    ]
+    # 3. Reuse the categories of comments classified in earlier runs
+    cache = open_cache()
+    keys = pd.Series(classification_keys(df['comment'].astype(str).fillna("nan")).values, index=df['email_id'])
+    cached = cached_categories(cache, keys)
+    print(f"{cached.notna().sum()} of {len(df)} emails already classified in the cache.")
 
-    print(f"Created {len(email_batches)} batches of approximately {batch_size} emails each.")
-
-    # 4. Asynchronously send batches for review
+    # 4. Asynchronously send the other emails for review, in batches that fit the token budget
     print("Sending email batches for classification...")
     review_chain = LLMChain(llm=llm, prompt=review_prompt)
-    llm_reviews = await run_concurrent_reviews(email_batches, review_chain)
+    to_classify = df[~df['email_id'].isin(cached.dropna().index)]
+    scheduler = RequestScheduler()
+    classifications, _, missing_ids = await classify_emails(
+        to_classify.set_index('email_id')['email_id_comment'], review_chain, scheduler,
+        on_classified=lambda rows: store_categories(cache, keys[rows['email_id']], rows['Category'])
+    )
+    cache.close()
+    classifications = pd.concat([
+        cached.dropna().rename('Category').rename_axis('email_id').reset_index(),
+        classifications
+    ], ignore_index=True)
 
-    # Add reviews to a new column (one review per batch)
-    df['Review'] = pd.Series([review for review in llm_reviews for _ in range(batch_size)])
+    # 5. Add each email's category in a new column
+    df = df.merge(classifications, on='email_id', how='left')
+    if missing_ids:
+        print(f"Warning: {len(missing_ids)} emails could not be classified (first ids: {missing_ids[:20]}).")
 
-    # 5. Summarize all LLM reviews
+    # 6. Summarize all classifications
     print("Generating final summary...")
-    all_reviews_text = "\n".join(llm_reviews)
-    summary_chain = LLMChain(llm=llm, prompt=summary_prompt)
-    final_summary = summarize_reviews(all_reviews_text, summary_chain)
+    final_summary = await summarize_reviews(
+        classifications, df.set_index('email_id')['email_id_comment'], len(df), scheduler
+    )
     
     # Add the summary to a new column
     df['Summary'] = final_summary
 
-    # 6. Save the results to a new Excel file
+    # 7. Save the results to a new Excel file
     output_filename = "classified_comments.xlsx"
     df.to_excel(output_filename, index=False)
 
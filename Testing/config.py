@@ -19,12 +19,72 @@ class Config:
     OUTPUT_PATH_METADATA = os.path.join(OSMOSE_PROJECT_PATH, "Autosearch Voice")
     OUTPUT_PATH_CONTENT = "Other Metadata for LLM/Charles content"
 
+    JOURNAL_DIR = os.path.join(OSMOSE_PROJECT_PATH, "journal")  # Completed units, for resuming runs
+
+    # Cookie reload: the browser is polled until these cookies exist (or, if empty, until the
+    # page is network-idle on the OSMOSE host and the cookie jar has not changed for
+    # COOKIE_SETTLE_SECONDS), giving up after COOKIE_READY_TIMEOUT_SECONDS.
+    COOKIE_REQUIRED_NAMES = []
+    COOKIE_READY_TIMEOUT_SECONDS = 30
+    COOKIE_SETTLE_SECONDS = 5
+    # Cookies that passed the readiness check are persisted so warm runs skip the browser
+    # launch, and refreshed in the background COOKIE_REFRESH_MARGIN_SECONDS before the
+    # OSMOSE authentication cookies (COOKIE_REQUIRED_NAMES, else the OSMOSE host's) expire.
+    COOKIE_STORE_PATH = os.path.join(os.path.expanduser("~"), ".osmose", "cookies.json")
+    COOKIE_SESSION_TTL_SECONDS = 8 * 3600  # Assumed lifetime of cookies without an expiry date
+    COOKIE_REFRESH_MARGIN_SECONDS = 300
+
     LOG_FILENAME = "fetch_requests.log"
     
     # Performance and Rate Limiting
-    MAX_CONCURRENT_REQUESTS = 10
+    # Concurrency adapts to server feedback (AIMD) between CONCURRENCY_MIN and MAX_CONCURRENT_REQUESTS:
+    # it grows while responses are faster than TARGET_LATENCY_SECONDS and halves on 429/5xx/timeouts.
+    MAX_CONCURRENT_REQUESTS = 32
+    CONCURRENCY_INITIAL = 10
+    CONCURRENCY_MIN = 1
+    TARGET_LATENCY_SECONDS = 2.0
+    # Transport: "aiohttp" (HTTP/1.1) or "httpx" (HTTP/2, needs `pip install httpx[http2]`).
+    HTTP_BACKEND = "aiohttp"
+    REQUEST_TIMEOUT_SECONDS = 60
+    KEEPALIVE_TIMEOUT_SECONDS = 60
+    DNS_CACHE_TTL_SECONDS = 600
+
     RATE_LIMIT_MAX_CALLS = 360
     RATE_LIMIT_PERIOD_SECONDS = 60
+    RATE_LIMIT_BURST = 10  # Calls allowed back to back before the steady rate applies
+    # Shared by every main.py process using this project folder; None keeps the budget per process.
+    RATE_LIMIT_STATE_FILE = os.path.join(OSMOSE_PROJECT_PATH, "rate_limit.state")
+    PARSE_PROCESSES = max(1, (os.cpu_count() or 2) - 1)  # HTML parsing worker processes; 0 parses in threads
+    PARSE_QUEUE_SIZE = 50  # Fetched contents waiting to be parsed before fetching pauses
+    CONTENT_WRITE_CHUNK_ROWS = 200  # Content rows buffered before being appended to the output CSV
+    CONTENT_INPUT_CHUNK_ROWS = 100_000  # Input CSV rows read at a time when loading the content input lazily
+    METADATA_FLUSH_ROWS = 10000  # Buffered search result rows per saved batch file
+    METADATA_OUTPUT_FORMAT = "csv"  # "csv" or "parquet" (needs pyarrow)
+    PARQUET_COMPRESSION = "zstd"
+    # CSV consolidation is incremental; its state (consolidated files, written keys) lives here.
+    CONSOLIDATION_STATE_PATH = os.path.join(OSMOSE_PROJECT_PATH, "consolidation_state.sqlite")
+    CONSOLIDATION_DEDUP_KEYS = ["Process_ID", "msgId"]  # Rows with a blank key are never deduplicated
+    CONSOLIDATION_READ_WORKERS = 4
+
+    # Search windowing: "adaptive" probes the whole date range and splits windows
+    # recursively near the result cap, "weekly" issues one request per 7-day slice.
+    SEARCH_WINDOW_MODE = "adaptive"
+    SEARCH_RESULT_CAP = 10000
+    SEARCH_SPLIT_THRESHOLD = 0.9  # Fraction of the cap at which a window is split
+    # Facets: "split" sends one request per direction/attachment/automated combination,
+    # "combined" one unfiltered request per keyword and window, deriving the facets from the
+    # SEARCH_FACET_FIELDS of each result's metadata (split requests are only sent when it is capped).
+    SEARCH_FACET_MODE = "split"
+    SEARCH_FACET_FIELDS = {"direction": "ext", "attachment": "isAttachment", "automated": "isAutomatedMail"}
+    THEME_WEIGHTS = {}  # Process_ID -> requests per round when themes share the queue (default 1)
+
+    # Response cache: "use" serves cached responses, "refresh" re-fetches and overwrites
+    # them, "bypass" disables the cache entirely (see the --refresh-cache/--no-cache flags).
+    CACHE_MODE = "use"
+    CACHE_PATH = os.path.join(OSMOSE_PROJECT_PATH, "cache", "responses.sqlite")
+    CACHE_TTL_SECONDS = 30 * 24 * 3600
+    CACHE_RECENT_TTL_SECONDS = 3600  # For search windows that reach today, whose results may still change
+    CACHE_MAX_BYTES = 2 * 1024 ** 3
 
     REQUEST_HEADERS = {
         "Accept": "application/json",
@@ -1,12 +1,21 @@
 import argparse
 import asyncio
 import logging
+import os
 
 from config import config
 from src.osmose.client import OsmoseClient
 from src.osmose.content_extractor import ContentExtractor
 from src.osmose.metadata_extractor import MetadataExtractor
 from src.utils.data_handler import DataHandler
+from src.utils.journal import ExtractionJournal
+
+def open_journal(filename: str, restart: bool) -> ExtractionJournal:
+    """Opens a resume journal, clearing it first when a fresh run is requested."""
+    journal = ExtractionJournal(os.path.join(config.JOURNAL_DIR, filename))
+    if restart:
+        journal.reset()
+    return journal
 
 async def main():
     """Main entry point for the script."""
@@ -16,28 +25,54 @@ async def main():
         choices=["metadata", "content", "all"], 
         help="The task to perform: 'metadata' extraction, 'content' extraction, or 'all'."
     )
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the on-disk response cache entirely."
+    )
+    cache_group.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Ignore cached responses and overwrite them with fresh ones."
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Discard the resume journal and start the selected tasks from scratch."
+    )
     args = parser.parse_args()
 
+    if args.no_cache:
+        config.CACHE_MODE = "bypass"
+    elif args.refresh_cache:
+        config.CACHE_MODE = "refresh"
+
     data_handler = DataHandler(config)
 
-    if args.task in ["metadata", "all"]:
-        logging.info("Starting metadata extraction task.")
-        themes_to_process = data_handler.load_and_process_metadata_input()
-        if not themes_to_process.empty:
-            async with OsmoseClient(config) as client:
-                extractor = MetadataExtractor(config, client)
+    # One client for all tasks, so connections and cookies are reused between them.
+    async with OsmoseClient(config) as client:
+        if args.task in ["metadata", "all"]:
+            logging.info("Starting metadata extraction task.")
+            themes_to_process = data_handler.load_and_process_metadata_input()
+            if not themes_to_process.empty:
+                journal = open_journal("metadata.jsonl", args.restart)
+                extractor = MetadataExtractor(config, client, journal)
                 await extractor.run(themes_to_process)
-            data_handler.consolidate_results()
-        logging.info("Metadata extraction task finished.")
-
-    if args.task in ["content", "all"]:
-        logging.info("Starting content extraction task.")
-        source_data = data_handler.load_and_process_content_input()
-        if not source_data.empty:
-            async with OsmoseClient(config) as client:
-                extractor = ContentExtractor(config, client)
-                await extractor.run(source_data)
-        logging.info("Content extraction task finished.")
+                journal.close()
+                data_handler.consolidate_results()
+            logging.info("Metadata extraction task finished.")
+
+        if args.task in ["content", "all"]:
+            logging.info("Starting content extraction task.")
+            total_rows, source_chunks = data_handler.iter_content_input()
+            if total_rows:
+                input_name = os.path.splitext(os.path.basename(config.INPUT_FILE_CONTENT))[0]
+                journal = open_journal(f"content_{input_name}.jsonl", args.restart)
+                extractor = ContentExtractor(config, client, journal)
+                await extractor.run(source_chunks, total=total_rows)
+                journal.close()
+            logging.info("Content extraction task finished.")
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -1,45 +1,213 @@
-import aiohttp
+import asyncio
+import contextlib
 import logging
-from typing import Dict, Optional
+import time
+from typing import Dict, Mapping, Optional
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
 
 from config import Config
+from src.utils.concurrency_controller import AdaptiveConcurrencyController, parse_retry_after
+from src.osmose.transport import create_transport
 from src.utils.cookie_manager import AsyncCookieManager
+from src.utils.cookie_store import CookieStore
+from src.utils import json_codec
+from src.utils.rate_limiter import RateLimiter
+from src.utils.response_cache import ResponseCache
+
+
+class OsmoseResponse:
+    """
+    A fully read HTTP response, served either from the network or from the response cache.
+
+    Header names are case-insensitive, whichever transport or cache entry they come from.
+    """
+    def __init__(self, url: str, status: int, headers: Mapping[str, str], body: bytes, from_cache: bool = False):
+        self.url = url
+        self.status = status
+        self.headers = CIMultiDict(headers)
+        self.body = body
+        self.from_cache = from_cache
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            request_info = aiohttp.RequestInfo(
+                URL(self.url), "GET", CIMultiDictProxy(CIMultiDict()), URL(self.url)
+            )
+            raise aiohttp.ClientResponseError(
+                request_info, (), status=self.status, message=f"HTTP {self.status}"
+            )
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self, encoding: str = "utf-8") -> str:
+        return self.body.decode(encoding, errors="replace")
+
+    async def json(self):
+        return json_codec.loads(self.body)
+
 
 class OsmoseClient:
     """A client for interacting with the Osmose API."""
     def __init__(self, config: Config):
         self._config = config
-        self._cookie_manager = AsyncCookieManager(config.OSMOSE_BASE_URL)
-        self._session: Optional[aiohttp.ClientSession] = None
+        self._cookie_manager = AsyncCookieManager(
+            config.OSMOSE_BASE_URL,
+            required_cookies=config.COOKIE_REQUIRED_NAMES,
+            ready_timeout=config.COOKIE_READY_TIMEOUT_SECONDS,
+            settle_time=config.COOKIE_SETTLE_SECONDS
+        )
+        self._cookie_store = CookieStore(
+            config.COOKIE_STORE_PATH,
+            config.COOKIE_SESSION_TTL_SECONDS,
+            site_url=config.OSMOSE_BASE_URL,
+            auth_names=config.COOKIE_REQUIRED_NAMES
+        )
+        self._cookie_refresh: Optional[asyncio.Future] = None
+        self._cookie_refresher: Optional[asyncio.Task] = None
+        self.cookie_expires_at = 0.0
+        self.cookie_generation = 0
+        self._transport = None
+        self._cache: Optional[ResponseCache] = None
         self.cookies: Dict[str, str] = {}
+        self.rate_limiter = RateLimiter(
+            config.RATE_LIMIT_MAX_CALLS,
+            config.RATE_LIMIT_PERIOD_SECONDS,
+            burst=config.RATE_LIMIT_BURST,
+            state_file=config.RATE_LIMIT_STATE_FILE
+        )
+        self.concurrency = AdaptiveConcurrencyController(
+            initial=config.CONCURRENCY_INITIAL,
+            minimum=config.CONCURRENCY_MIN,
+            maximum=config.MAX_CONCURRENT_REQUESTS,
+            target_latency=config.TARGET_LATENCY_SECONDS
+        )
 
     async def __aenter__(self):
-        self.cookies = await self._cookie_manager.reload()
-        self._session = aiohttp.ClientSession(
-            headers=self._config.REQUEST_HEADERS,
-            cookies=self.cookies
-        )
+        stored = self._cookie_store.load()
+        if stored and stored[1] - time.time() > self._config.COOKIE_REFRESH_MARGIN_SECONDS:
+            logging.info("Reusing stored authentication cookies.")
+            self.cookies, self.cookie_expires_at = stored
+        else:
+            await self._load_cookies()
+        self._transport = create_transport(self._config, self.cookies)
+        self._cookie_refresher = asyncio.create_task(self._refresh_before_expiry())
+        if self._config.CACHE_MODE != "bypass":
+            self._cache = ResponseCache(
+                self._config.CACHE_PATH,
+                self._config.CACHE_TTL_SECONDS,
+                self._config.CACHE_MAX_BYTES
+            )
         return self
 
     async def __aexit__(self, exc_type, exc_val, tb):
-        if self._session:
-            await self._session.close()
+        if self._cookie_refresher:
+            self._cookie_refresher.cancel()
+            await asyncio.gather(self._cookie_refresher, return_exceptions=True)
+        if self._transport:
+            await self._transport.close()
+            self._transport = None
+        if self._cache:
+            self._cache.close()
+
+    @contextlib.asynccontextmanager
+    async def get(self, url: str, timeout: Optional[float] = None, use_cache: bool = True):
+        """
+        Performs a GET request, used as 'async with client.get(url) as response'.
+
+        Responses are served from the response cache according to CACHE_MODE, unless
+        use_cache is False (e.g. for a retry after a cookie reload). Nothing is stored
+        here: callers pass a response to cache_response once they have validated its body.
+        """
+        yield await self.fetch(url, timeout=timeout, use_cache=use_cache)
 
-    async def get(self, url: str, **kwargs) -> aiohttp.ClientResponse:
-        """Performs a GET request."""
-        if not self._session:
+    async def fetch(self, url: str, timeout: Optional[float] = None, use_cache: bool = True) -> OsmoseResponse:
+        """Performs a GET request and returns the fully read response."""
+        if not self._transport:
             raise RuntimeError("Session not started. Use 'async with' statement.")
-        return await self._session.get(url, **kwargs)
 
-    async def reload_cookies_and_retry(self):
-        """Reloads cookies and updates the session."""
-        logging.info("Reloading cookies and updating session...")
-        self.cookies = await self._cookie_manager.reload()
-        if self._session and not self._session.closed:
-            self._session.cookie_jar.clear()
-            self._session.cookie_jar.update_cookies(self.cookies)
+        if use_cache and self._cache and self._config.CACHE_MODE == "use":
+            cached = self._cache.get(url)
+            if cached is not None:
+                status, headers, body = cached
+                return OsmoseResponse(url, status, headers, body, from_cache=True)
+
+        await self.concurrency.acquire()
+        latency, overloaded, retry_after = None, False, None
+        try:
+            async with self.rate_limiter:
+                started = time.monotonic()
+                status, headers, body = await self._transport.get(url, timeout=timeout)
+                result = OsmoseResponse(url, status, headers, body)
+            latency = time.monotonic() - started
+            overloaded = result.status == 429 or result.status >= 500
+            retry_after = parse_retry_after(result.headers.get("Retry-After"))
+        except asyncio.TimeoutError:
+            overloaded = True
+            raise
+        finally:
+            await self.concurrency.release(latency, overloaded, retry_after)
+
+        return result
+
+    def cache_response(self, response: OsmoseResponse, cache_ttl: Optional[int] = None):
+        """
+        Stores a response whose body the caller has validated; cache_ttl overrides the
+        default expiry. Cache hits and non-200 responses are not stored.
+        """
+        if self._cache and response.status == 200 and not response.from_cache:
+            self._cache.put(response.url, response.status, dict(response.headers), response.body, ttl_seconds=cache_ttl)
+
+    async def reload_cookies_and_retry(self, generation: Optional[int] = None):
+        """
+        Reloads cookies and updates the session, once for all concurrent callers.
+
+        Callers arriving while a reload is running wait for that same reload. A caller that
+        passes the cookie_generation its request was sent with skips the reload entirely if
+        the cookies have been refreshed since, and can simply re-issue its request.
+        """
+        if generation is not None and generation < self.cookie_generation:
+            return
+        if self._cookie_refresh is None:
+            self._cookie_refresh = asyncio.ensure_future(self._refresh_cookies())
+        refresh = self._cookie_refresh
+        try:
+            await asyncio.shield(refresh)
+        finally:
+            if refresh.done() and self._cookie_refresh is refresh:
+                self._cookie_refresh = None
+
+    async def _load_cookies(self):
+        """
+        Fetches fresh cookies from the browser and persists them with their expiry.
+
+        Cookies that did not pass the readiness check are used for this run but not stored.
+        """
+        raw_cookies, ready = await self._cookie_manager.fetch_cookies()
+        self.cookies = {cookie['name']: cookie['value'] for cookie in raw_cookies}
+        if ready:
+            self.cookie_expires_at = self._cookie_store.save(raw_cookies)
         else:
-            self._session = aiohttp.ClientSession(
-                headers=self._config.REQUEST_HEADERS,
-                cookies=self.cookies
-            ) 
\ No newline at end of file
+            logging.warning("Not persisting cookies that did not pass the readiness check.")
+            self.cookie_expires_at = self._cookie_store.expires_at(raw_cookies, time.time())
+
+    async def _refresh_before_expiry(self):
+        """Background task reloading cookies shortly before they expire."""
+        while True:
+            delay = self.cookie_expires_at - self._config.COOKIE_REFRESH_MARGIN_SECONDS - time.time()
+            await asyncio.sleep(max(delay, 60))
+            logging.info("Authentication cookies about to expire, refreshing in the background.")
+            try:
+                await self.reload_cookies_and_retry(self.cookie_generation)
+            except Exception as e:
+                logging.error(f"Background cookie refresh failed: {e}")
+
+    async def _refresh_cookies(self):
+        logging.info("Reloading cookies and updating session...")
+        await self._load_cookies()
+        if self._transport:
+            self._transport.update_cookies(self.cookies)
+        self.cookie_generation += 1
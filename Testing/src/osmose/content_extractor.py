@@ -1,108 +1,148 @@
 import asyncio
-import csv
 import logging
 import os
 import time
-from typing import Any, Dict, List, Optional
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, Optional, Union
 
 import pandas as pd
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md
 from tqdm.asyncio import tqdm
 
 from config import Config
-from src.osmose.client import OsmoseClient
-from src.utils.rate_limiter import RateLimiter
+from src.osmose.client import OsmoseClient, OsmoseResponse
+from src.osmose.html_renderer import render_content
+from src.utils.journal import ExtractionJournal
+from src.utils.output_writer import ContentOutputWriter
 
 
 class ContentFetcher:
     """Handles fetching web content with retries and cookie management."""
-    def __init__(self, config: Config, client: OsmoseClient, rate_limiter: RateLimiter):
+    def __init__(self, config: Config, client: OsmoseClient):
         self._config = config
         self._client = client
-        self._rate_limiter = rate_limiter
 
-    async def get_content(self, url: str, retries: int = 5) -> Optional[bytes]:
-        """Fetches content from a URL with retry logic."""
+    async def get_content(self, url: str, retries: int = 5) -> Optional[OsmoseResponse]:
+        """
+        Fetches content from a URL with retry logic and returns the 200 response.
+
+        Attempts after a cookie reload bypass the response cache. The response is not cached
+        here; the caller passes it to OsmoseClient.cache_response once it has been processed.
+        """
+        use_cache = True
         for attempt in range(retries):
+            generation = self._client.cookie_generation
+            unauthorized = False
             try:
-                async with self._rate_limiter:
-                    async with self._client.get(url, timeout=25) as response:
-                        logging.info(f"Attempt {attempt+1} for URL: {url}; Status: {response.status}")
-                        if response.status == 200:
-                            return await response.read()
-                        
-                        error_text = await response.text()
-                        logging.error(f"Unexpected status {response.status} for {url}. Response: {error_text}")
-                        if 400 <= response.status < 500:
-                           break
+                async with self._client.get(url, timeout=25, use_cache=use_cache) as response:
+                    logging.info(f"Attempt {attempt+1} for URL: {url}; Status: {response.status}")
+                    if response.status == 200:
+                        return response
+
+                    error_text = await response.text()
+                    logging.error(f"Unexpected status {response.status} for {url}. Response: {error_text}")
+                    unauthorized = response.status in (401, 403)
+                    if 400 <= response.status < 500 and response.status != 429 and not unauthorized:
+                       break
             except Exception as e:
                 logging.error(f"Attempt {attempt+1} failed for {url}. Error: {e}")
 
-            if attempt == 1 and attempt < retries - 1:
-                logging.info("Second attempt failed. Reloading cookies before next retry.")
-                await self._client.reload_cookies_and_retry()
+            if (unauthorized or attempt == 1) and attempt < retries - 1:
+                logging.info("Reloading cookies before next retry.")
+                await self._client.reload_cookies_and_retry(generation)
+                use_cache = False
+                if unauthorized:
+                    continue
 
             if attempt < retries - 1:
-                wait_time = 2 ** attempt
-                logging.info(f"Waiting for {wait_time}s before retrying...")
+                wait_time = self._client.concurrency.retry_delay(attempt)
+                logging.info(f"Waiting for {wait_time:.1f}s before retrying...")
                 await asyncio.sleep(wait_time)
         
         logging.error(f"Exhausted all retries for URL: {url}")
         return None
 
 
+class ContentRow:
+    """The fields of one input row the content pipeline uses, without per-row Series overhead."""
+    __slots__ = ("URL", "DATE", "Keyword", "msgId", "isAttachment", "Title_eng", "extension")
+
+    def __init__(self, URL=None, DATE=None, Keyword=None, msgId=None, isAttachment=None,
+                 Title_eng=None, extension=None):
+        self.URL = URL
+        self.DATE = DATE
+        self.Keyword = Keyword
+        self.msgId = msgId
+        self.isAttachment = isAttachment
+        self.Title_eng = Title_eng
+        self.extension = extension
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> Iterator["ContentRow"]:
+        """Yields a record per DataFrame row; missing columns are left as None."""
+        columns = df.reindex(columns=list(cls.__slots__)).astype(object)
+        for values in columns.itertuples(index=False, name=None):
+            yield cls(*values)
+
+
 class RowProcessor:
     """Processes a single data row: fetches, parses, and saves content."""
-    def __init__(self, fetcher: ContentFetcher, output_dir: str):
+    def __init__(self, fetcher: ContentFetcher, output_dir: str, executor: Optional[Executor] = None):
         self._fetcher = fetcher
         self._output_dir = output_dir
+        self._executor = executor
 
-    async def process(self, row_data: pd.Series) -> Optional[Dict[str, Any]]:
-        """Processes a single row from the input data."""
-        url = row_data.get('URL', '')
+    async def fetch(self, row_data: ContentRow) -> Optional[OsmoseResponse]:
+        """Fetches the response for a row, or returns None if it cannot be fetched."""
+        url = row_data.URL
         if not url:
-            logging.warning(f"No URL for DATE: {row_data['DATE']} and Keyword: {row_data['Keyword']}")
+            logging.warning(f"No URL for DATE: {row_data.DATE} and Keyword: {row_data.Keyword}")
             return None
 
         content = await self._fetcher.get_content(url)
         if content is None:
-            logging.error(f"Failed to fetch url: {url}, Skipping DATE: {row_data['DATE']} and Keyword: {row_data['Keyword']}")
-            return None
-
-        soup = BeautifulSoup(content, 'html.parser')
+            logging.error(f"Failed to fetch url: {url}, Skipping DATE: {row_data.DATE} and Keyword: {row_data.Keyword}")
+        return content
 
-        date_keyword_folder = os.path.join(self._output_dir, f"{row_data['DATE']}_{row_data['Keyword']}")
-        os.makedirs(date_keyword_folder, exist_ok=True)
-
-        unique_filename = f"{row_data['msgId'] if row_data['msgId'] else int(time.time() * 1000)}.html"
+    async def render(self, row_data: ContentRow, content: bytes) -> Optional[Dict[str, Any]]:
+        """Parses and saves fetched content in the executor, off the event loop."""
+        url = row_data.URL
+        date_keyword_folder = os.path.join(self._output_dir, f"{row_data.DATE}_{row_data.Keyword}")
+        unique_filename = f"{row_data.msgId if row_data.msgId else int(time.time() * 1000)}.html"
         html_file_path = os.path.join(date_keyword_folder, unique_filename)
+
+        loop = asyncio.get_running_loop()
         try:
-            with open(html_file_path, "w", encoding="utf-8") as html_file:
-                html_file.write(soup.prettify())
+            markdown_content = await loop.run_in_executor(self._executor, render_content, content, html_file_path)
         except IOError as e:
             logging.error(f"Error saving HTML file for URL: {url}. Error: {e}")
             return None
 
-        markdown_content = md(str(soup))
         return {
-            "DATE": row_data["DATE"],
-            "Keyword": row_data["Keyword"],
-            "msgId": row_data["msgId"],
-            "isAttachment": row_data["isAttachment"],
-            "Title": row_data["Title_eng"],
-            "Extension": row_data["extension"],
+            "DATE": row_data.DATE,
+            "Keyword": row_data.Keyword,
+            "msgId": row_data.msgId,
+            "isAttachment": row_data.isAttachment,
+            "Title": row_data.Title_eng,
+            "Extension": row_data.extension,
             "URL": url,
             "HTML File Path": html_file_path,
             "Content": markdown_content
         }
 
+    async def process(self, row_data: ContentRow) -> Optional[Dict[str, Any]]:
+        """Processes a single row from the input data."""
+        response = await self.fetch(row_data)
+        if response is None:
+            return None
+        return await self.render(row_data, response.body)
+
 
 class ContentExtractor:
     """Orchestrates the entire content extraction process."""
-    def __init__(self, config: Config, client: OsmoseClient):
+    def __init__(self, config: Config, client: OsmoseClient, journal: Optional[ExtractionJournal] = None):
         self._config = config
         self._client = client
+        self._journal = journal
         self._setup_logging()
         os.makedirs(self._config.OUTPUT_PATH_CONTENT, exist_ok=True)
 
@@ -116,63 +156,130 @@ class ContentExtractor:
             ]
         )
 
-    def _save_results(self, results: List[Dict[str, Any]]):
-        """Saves the extracted content to CSV and Excel files."""
-        if not results:
-            logging.warning("No results to save.")
-            return
+    @staticmethod
+    def _unit_key(row: ContentRow) -> str:
+        """
+        Identifies a row in the journal by its msgId (falling back to its URL), DATE and Keyword.
+
+        One message can appear in several input rows with a different DATE or Keyword, each
+        saved in its own folder, so the msgId alone does not identify a row.
+        """
+        msg_id = row.msgId
+        message = str(msg_id) if pd.notna(msg_id) and msg_id != '' else str(row.URL or '')
+        return "\x1f".join([message, *("" if pd.isna(value) else str(value) for value in (row.DATE, row.Keyword))])
 
-        results_df = pd.DataFrame(results)
+    def _output_paths(self) -> tuple:
+        """Returns the CSV and Excel output paths derived from the input file name."""
         base_filename = os.path.basename(self._config.INPUT_FILE_CONTENT)
         filename_without_ext = os.path.splitext(base_filename)[0]
 
         csv_output_path = f"Content_extract_{filename_without_ext}.csv"
         excel_output_path = os.path.join(self._config.OUTPUT_PATH_CONTENT, f"{filename_without_ext}_Content_Extract.xlsx")
+        return csv_output_path, excel_output_path
 
-        try:
-            results_df.to_csv(
-                csv_output_path,
-                index=False,
-                sep='\t',
-                encoding='utf-8-sig',
-                quoting=csv.QUOTE_ALL
-            )
-            logging.info(f"Exported results to CSV: {csv_output_path}")
-
-            results_df.to_excel(excel_output_path, index=False, engine='openpyxl')
-            logging.info(f"Exported results to Excel: {excel_output_path}")
-        except Exception as e:
-            logging.error(f"Error saving output files: {e}")
+    async def run(self, source_data: Union[pd.DataFrame, Iterable[pd.DataFrame]], total: Optional[int] = None):
+        """
+        Executes the full extraction pipeline.
 
-    async def run(self, source_data: pd.DataFrame):
-        """Executes the full extraction pipeline."""
-        if source_data is None or source_data.empty:
+        source_data is either a DataFrame or an iterable of DataFrame chunks (as produced by
+        DataHandler.iter_content_input), which is consumed lazily; total sizes the progress bar.
+        Rows travel through the pipeline as ContentRow records.
+        """
+        if isinstance(source_data, pd.DataFrame):
+            total = len(source_data)
+            source_data = [source_data]
+        if source_data is None or total == 0:
             logging.error("Halting execution due to data loading issues.")
             return
 
-        rate_limiter = RateLimiter(self._config.RATE_LIMIT_MAX_CALLS, self._config.RATE_LIMIT_PERIOD_SECONDS)
-        concurrency_semaphore = asyncio.Semaphore(self._config.MAX_CONCURRENT_REQUESTS)
+        completed = set()
+        if self._journal:
+            completed = {entry["unit"] for entry in self._journal.entries}
+            if completed:
+                logging.info(f"Resuming content extraction: {len(completed)} rows already completed.")
 
-        fetcher = ContentFetcher(self._config, self._client, rate_limiter)
-        processor = RowProcessor(fetcher, self._config.OUTPUT_PATH_CONTENT)
-        
-        async def process_with_semaphore(row):
-            async with concurrency_semaphore:
-                return await processor.process(row)
-
-        tasks = [
-            asyncio.create_task(process_with_semaphore(row))
-            for _, row in source_data.iterrows()
-        ]
-
-        results = []
-        progress_bar = tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing rows")
-        for future in progress_bar:
-            try:
-                result = await future
-                if result:
-                    results.append(result)
-            except Exception as e:
-                logging.error(f"Error processing a row task: {e}")
+        def record_flushed(rows):
+            if self._journal:
+                for row in rows:
+                    self._journal.record(unit=row["_unit"])
+
+        csv_output_path, excel_output_path = self._output_paths()
+        writer = ContentOutputWriter(
+            csv_output_path,
+            chunk_rows=self._config.CONTENT_WRITE_CHUNK_ROWS,
+            append=bool(completed),
+            on_flush=record_flushed
+        )
+
+        parse_processes = self._config.PARSE_PROCESSES
+        executor = ProcessPoolExecutor(max_workers=parse_processes) if parse_processes > 0 else None
+        fetcher = ContentFetcher(self._config, self._client)
+        processor = RowProcessor(fetcher, self._config.OUTPUT_PATH_CONTENT, executor)
+
+        # Fetching and parsing are separate stages joined by a bounded queue: fetch workers
+        # keep the connections busy, and only block when parsing has fallen too far behind.
+        fetch_worker_count = max(1, self._config.MAX_CONCURRENT_REQUESTS)
+        parse_worker_count = max(1, parse_processes)
+        fetch_queue = asyncio.Queue(maxsize=fetch_worker_count * 2)
+        parse_queue = asyncio.Queue(maxsize=self._config.PARSE_QUEUE_SIZE)
+        progress_bar = tqdm(total=total, desc="Processing rows")
 
-        self._save_results(results) 
\ No newline at end of file
+        async def fetch_worker():
+            while True:
+                row = await fetch_queue.get()
+                try:
+                    response = await processor.fetch(row)
+                    if response is None:
+                        progress_bar.update(1)
+                    else:
+                        await parse_queue.put((row, response))
+                except Exception as e:
+                    logging.error(f"Error fetching a row: {e}")
+                    progress_bar.update(1)
+                finally:
+                    fetch_queue.task_done()
+
+        async def parse_worker():
+            while True:
+                row, response = await parse_queue.get()
+                try:
+                    result = await processor.render(row, response.body)
+                    if result:
+                        # Cached only once the content was rendered and saved.
+                        self._client.cache_response(response)
+                        result["_unit"] = self._unit_key(row)
+                        writer.write(result)
+                except Exception as e:
+                    logging.error(f"Error processing a row: {e}")
+                finally:
+                    progress_bar.update(1)
+                    parse_queue.task_done()
+
+        workers = [asyncio.create_task(fetch_worker()) for _ in range(fetch_worker_count)]
+        workers += [asyncio.create_task(parse_worker()) for _ in range(parse_worker_count)]
+        try:
+            for chunk in source_data:
+                for row in ContentRow.from_frame(chunk):
+                    if self._unit_key(row) in completed:
+                        progress_bar.update(1)
+                        continue
+                    await fetch_queue.put(row)
+            await fetch_queue.join()
+            await parse_queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            progress_bar.close()
+            writer.close()
+            if executor:
+                executor.shutdown()
+
+        if not writer.rows_written and not completed:
+            logging.warning("No results to save.")
+            return
+        logging.info(f"Exported results to CSV: {csv_output_path}")
+        try:
+            writer.export_excel(excel_output_path)
+        except Exception as e:
+            logging.error(f"Error saving output files: {e}")
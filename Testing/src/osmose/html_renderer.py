@@ -0,0 +1,20 @@
+import os
+
+from bs4 import BeautifulSoup
+from markdownify import markdownify as md
+
+
+def render_content(content: bytes, html_file_path: str) -> str:
+    """
+    Parses fetched content, saves it as prettified HTML and returns it as markdown.
+
+    This is the CPU-bound part of content extraction. It is kept in its own lightweight
+    module so that it can run in worker processes without importing the rest of the app.
+    """
+    soup = BeautifulSoup(content, 'html.parser')
+
+    os.makedirs(os.path.dirname(html_file_path), exist_ok=True)
+    with open(html_file_path, "w", encoding="utf-8") as html_file:
+        html_file.write(soup.prettify())
+
+    return md(str(soup))
@@ -2,104 +2,436 @@ import asyncio
 import itertools
 import json
 import logging
+import math
 import os
-import time
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
 
 import aiohttp
-import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 from config import Config
 from src.osmose.client import OsmoseClient
+from src.utils import json_codec
+from src.utils.columnar import HAS_PYARROW, write_parquet
+from src.utils.journal import ExtractionJournal
+
+# Facet value of a combined request, which leaves that facet unfiltered.
+ALL_FACETS = "*"
+
+
+class SearchParams(NamedTuple):
+    """A single search request: one keyword, facet combination and day window."""
+    keyword: str
+    direction: str
+    attachment: str
+    automated: str
+    start_day: int
+    end_day: int
+
+
+class ThemeExtraction:
+    """
+    Output state of one theme (Process_ID) while its searches run in the shared pipeline.
+
+    Results are buffered and saved in the theme's own folder every METADATA_FLUSH_ROWS rows,
+    and journaled under its Process_ID, so themes stay separate however they interleave.
+    """
+    def __init__(self, extractor: "MetadataExtractor", process_id: str, keywords: list):
+        self._extractor = extractor
+        self.process_id = process_id
+        self.keywords = keywords
+        self.total = math.prod(len(axis) for axis in extractor._search_axes(keywords))
+        self.completed, self.split, self._batch_number = extractor._journal_state(process_id)
+        self.failed: List[SearchParams] = []
+        self._buffer = []
+        self._buffered_units = []
+        self._buffered_rows = 0
+
+    def search_params(self) -> Iterator[SearchParams]:
+        """Yields the theme's search requests that are not completed yet."""
+        extractor = self._extractor
+        return extractor._skip_completed(
+            extractor._prepare_search_parameters(self.keywords), self.completed, self.split
+        )
+
+    def on_result(self, params: SearchParams, df: pd.DataFrame):
+        journal = self._extractor.journal
+        if df.empty:
+            if journal:
+                journal.record(process_id=self.process_id, batch=None, units=[MetadataExtractor._unit_key(params)])
+            return
+        self._buffer.append(df)
+        self._buffered_units.append(MetadataExtractor._unit_key(params))
+        self._buffered_rows += len(df)
+        if self._buffered_rows >= self._extractor.config.METADATA_FLUSH_ROWS:
+            self.flush()
+
+    def on_split(self, params: SearchParams):
+        if self._extractor.journal:
+            self._extractor.journal.record(process_id=self.process_id, split=MetadataExtractor._unit_key(params))
+
+    def flush(self):
+        """Saves the buffered results as the theme's next batch file."""
+        if not self._buffer:
+            return
+        journal = self._extractor.journal
+        try:
+            batch_df = pd.concat(self._buffer, ignore_index=True)
+            self._extractor._save_results(batch_df, self.process_id, self._batch_number)
+            if journal:
+                journal.record(process_id=self.process_id, batch=self._batch_number, units=list(self._buffered_units))
+        except Exception as e:
+            logging.error(f"Error processing or saving batch {self._batch_number} for {self.process_id}: {e}")
+        self._buffer.clear()
+        self._buffered_units.clear()
+        self._buffered_rows = 0
+        self._batch_number += 1
+
 
 class MetadataExtractor:
     """
     Manages connection to OSMOSE, performs searches, and extracts metadata.
     """
-    def __init__(self, config: Config, client: OsmoseClient):
+    def __init__(self, config: Config, client: OsmoseClient, journal: Optional[ExtractionJournal] = None):
         self.config = config
         self.client = client
+        self.journal = journal
         self.error_log = {}
+        self.truncated = []
+        if self.config.METADATA_OUTPUT_FORMAT == "parquet" and not HAS_PYARROW:
+            logging.warning("pyarrow is not installed, writing metadata as CSV instead of Parquet.")
+            self.config.METADATA_OUTPUT_FORMAT = "csv"
 
-    def _prepare_search_parameters(self, keywords: list) -> list:
-        """Generates all combinations of search parameters for API requests."""
+    def _search_windows(self) -> List[tuple]:
+        """Returns the initial (start_day, end_day) windows, inclusive, in days since 1970."""
         start_days = (self.config.START_DATE - pd.Timestamp("1970-01-01")).days
         end_days = (self.config.END_DATE - pd.Timestamp("1970-01-01")).days
-        weekly_start_days = list(range(start_days, end_days, 7))
+        if self.config.SEARCH_WINDOW_MODE == "weekly":
+            return [(day, day + 6) for day in range(start_days, end_days, 7)]
+        return [(start_days, end_days)] if start_days <= end_days else []
 
+    @staticmethod
+    def _facet_values() -> tuple:
+        """Returns the direction, attachment and automated values searched for."""
         directions = ["i", "o", "n"]
         is_attachment = ["true", "false"]
         is_automated = ["true", "false"]
+        return directions, is_attachment, is_automated
+
+    def _search_axes(self, keywords: list) -> tuple:
+        """Returns the value lists whose product forms the search parameter grid."""
+        if self.config.SEARCH_FACET_MODE == "combined":
+            facets = ([ALL_FACETS], [ALL_FACETS], [ALL_FACETS])
+        else:
+            facets = self._facet_values()
+        return (keywords, *facets, self._search_windows())
+
+    def _prepare_search_parameters(self, keywords: list) -> Iterator[SearchParams]:
+        """Lazily yields all combinations of search parameters for API requests."""
+        for keyword, direction, attachment, automated, (start_day, end_day) in itertools.product(
+            *self._search_axes(keywords)
+        ):
+            yield SearchParams(keyword, direction, attachment, automated, start_day, end_day)
+
+    def _split_if_saturated(self, params: SearchParams, df: pd.DataFrame) -> List[SearchParams]:
+        """
+        Returns the two halves of the window if its result count is near the cap.
+
+        An empty list means the response is complete and can be kept. A single-day
+        window cannot be split further, so a saturated one is kept and reported.
+        """
+        threshold = self.config.SEARCH_RESULT_CAP * self.config.SEARCH_SPLIT_THRESHOLD
+        total = df.attrs.get("total")
+        saturated = len(df) >= threshold or (total is not None and total > len(df))
+        if params.direction == ALL_FACETS and not saturated and self._facet_columns(df) is None:
+            logging.warning(
+                f"Search results lack the SEARCH_FACET_FIELDS metadata, "
+                f"falling back to one request per facet for {self._build_url(params)}."
+            )
+            saturated = True
+        if not saturated:
+            return []
+        halves = self._subdivide(params)
+        if not halves:
+            logging.warning(
+                f"Results for {self._build_url(params)} may be truncated: "
+                f"{len(df)} hits in a single-day window."
+            )
+            self.truncated.append(params)
+        return halves
+
+    @staticmethod
+    def _halves(params: SearchParams) -> List[SearchParams]:
+        """Splits a window into two halves, or returns [] for a single-day window."""
+        if params.start_day >= params.end_day:
+            return []
+        middle = (params.start_day + params.end_day) // 2
+        return [
+            params._replace(end_day=middle),
+            params._replace(start_day=middle + 1),
+        ]
+
+    def _subdivide(self, params: SearchParams) -> List[SearchParams]:
+        """Splits a combined request into one request per facet, and any other into two halves."""
+        if params.direction == ALL_FACETS:
+            return [
+                params._replace(direction=direction, attachment=attachment, automated=automated)
+                for direction, attachment, automated in itertools.product(*self._facet_values())
+            ]
+        return self._halves(params)
+
+    def _facet_columns(self, df: pd.DataFrame) -> Optional[pd.DataFrame]:
+        """
+        Returns the direction, attachment and automated value of every result row, as the
+        query parameters spell them, or None if the metadata does not carry all of them.
+        """
+        if df.empty:
+            return pd.DataFrame(columns=["direction", "attachment", "automated"])
+        fields = self.config.SEARCH_FACET_FIELDS
+        columns = {}
+        for facet in ("direction", "attachment", "automated"):
+            values = df.get(fields[facet])
+            if values is None or values.isna().any():
+                return None
+            columns[facet] = values.astype(str).str.lower()
+        return pd.DataFrame(columns, index=df.index)
+
+    def _derive_facets(self, params: SearchParams, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Keeps the rows of a combined request that the per-facet requests would have returned.
 
-        return list(itertools.product(
-            keywords, directions, is_attachment, is_automated, weekly_start_days
-        ))
+        The facet values are read from each row's metadata, so one unfiltered request
+        replaces the whole direction x attachment x automated grid.
+        """
+        if params.direction != ALL_FACETS or df.empty:
+            return df
+        facets = self._facet_columns(df)
+        directions, is_attachment, is_automated = self._facet_values()
+        in_grid = (
+            facets["direction"].isin(directions)
+            & facets["attachment"].isin(is_attachment)
+            & facets["automated"].isin(is_automated)
+        )
+        if not in_grid.all():
+            logging.info(f"Dropping {(~in_grid).sum()} results outside the searched facets for {self._build_url(params)}.")
+        return df[in_grid]
+
+    @staticmethod
+    def _unit_key(params: SearchParams) -> str:
+        """Identifies a search request in the journal."""
+        return "|".join(str(value) for value in params)
+
+    def _journal_state(self, process_id: str) -> tuple:
+        """Returns the completed and split unit keys and the next batch number for a theme."""
+        completed, split = set(), set()
+        next_batch = 0
+        if self.journal is None:
+            return completed, split, next_batch
+        for entry in self.journal.entries:
+            if entry.get("process_id") != process_id:
+                continue
+            if "split" in entry:
+                split.add(entry["split"])
+            else:
+                completed.update(entry.get("units", []))
+            if entry.get("batch") is not None:
+                next_batch = max(next_batch, entry["batch"] + 1)
+        return completed, split, next_batch
+
+    def _skip_completed(self, search_params: Iterable[SearchParams], completed: set,
+                        split: set) -> Iterator[SearchParams]:
+        """Yields the search requests still to do, expanding windows already known to be split."""
+        for params in search_params:
+            key = self._unit_key(params)
+            if key in completed:
+                continue
+            if key in split:
+                yield from self._skip_completed(self._subdivide(params), completed, split)
+            else:
+                yield params
+
+    def _cache_ttl(self, params: SearchParams) -> Optional[int]:
+        """Windows reaching today may still gain results, so they are only cached briefly."""
+        today = (pd.Timestamp.now() - pd.Timestamp("1970-01-01")).days
+        return self.config.CACHE_RECENT_TTL_SECONDS if params.end_day >= today else None
 
-    async def _fetch_url(self, url: str) -> pd.DataFrame:
-        """Performs a single GET request and returns a DataFrame or an empty string on failure."""
+    async def _fetch_url(self, url: str, cache_ttl: Optional[int] = None, use_cache: bool = True) -> pd.DataFrame:
+        """
+        Performs a single GET request and returns a DataFrame or an "error" string on failure.
+
+        The body is decoded with the fastest available JSON parser and the records' metadata
+        flattened into columns as the response's DataFrame is built, instead of normalizing
+        every saved batch again. Only responses holding search results are cached, so a login
+        page served with status 200 is fetched again once cookies are reloaded.
+        """
         try:
-            async with self.client.get(url) as response:
+            async with self.client.get(url, use_cache=use_cache) as response:
                 response.raise_for_status()
-                json_body = await response.json()
+                json_body = json_codec.loads(await response.read())
                 if "results" in json_body and "results" in json_body["results"]:
-                    return pd.DataFrame(json_body["results"]["results"])
+                    df = json_codec.records_to_frame(json_body["results"]["results"])
+                    total = json_body["results"].get("total")
+                    if isinstance(total, int):
+                        df.attrs["total"] = total
+                    self.client.cache_response(response, cache_ttl)
+                    return df
                 return pd.DataFrame()
-        except aiohttp.ClientError as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logging.error(f"Request failed for {url}: {e}")
             return "error"
         except json.JSONDecodeError:
             logging.error(f"Failed to decode JSON from {url}")
             return "error"
 
-    async def _run_extraction_for_theme(self, process_id: str, keywords: list):
-        """Runs the complete extraction process for a single theme."""
-        logging.info(f"--- Starting extraction for Process ID: {process_id} ---")
-        search_params = self._prepare_search_parameters(keywords)
-        if not search_params:
-            logging.warning(f"No search parameters generated for {process_id}. Skipping.")
-            return
+    def _interleave(self, themes: List[ThemeExtraction]) -> Iterator[tuple]:
+        """
+        Merges the search requests of all themes into one (theme, params) stream.
+
+        Themes take turns in weighted round robin: each round, a theme contributes as many
+        requests as its THEME_WEIGHTS entry (1 by default), so small themes are not starved
+        behind large ones and finish early instead of waiting their turn.
+        """
+        active = [(theme, theme.search_params()) for theme in themes]
+        while active:
+            still_active = []
+            for theme, params_iter in active:
+                weight = max(1, int(self.config.THEME_WEIGHTS.get(theme.process_id, 1)))
+                batch = list(itertools.islice(params_iter, weight))
+                for params in batch:
+                    yield theme, params
+                if len(batch) == weight:
+                    still_active.append((theme, params_iter))
+            active = still_active
 
-        request_batches = np.array_split(search_params, max(1, len(search_params) // 5))
-        
-        for i, batch in enumerate(tqdm(request_batches, desc=f"Processing batches for {process_id}")):
-            tasks = [self._fetch_url(self._build_url(params)) for params in batch]
-            results = await asyncio.gather(*tasks)
-
-            retry_needed = any(res == "error" for res in results)
-            if retry_needed:
-                logging.info("Failures detected, reloading cookies and retrying batch...")
-                await self.client.reload_cookies_and_retry()
-                
-                tasks_to_retry = [
-                    self._fetch_url(self._build_url(params)) 
-                    for j, params in enumerate(batch) if results[j] == "error"
-                ]
-                retry_results = await asyncio.gather(*tasks_to_retry)
-                
-                final_results = []
-                retry_iter = iter(retry_results)
-                for res in results:
-                    final_results.append(next(retry_iter) if res == "error" else res)
-                results = final_results
-
-            valid_results = [df for df in results if isinstance(df, pd.DataFrame) and not df.empty]
-            if not valid_results:
+    def _plan_requests(self, themes: List[ThemeExtraction],
+                       open_requests: Dict[SearchParams, list]) -> Iterator[tuple]:
+        """
+        Yields the search requests of the run as (themes, params) pairs, deduplicated as produced.
+
+        Themes sharing keywords would otherwise fetch the same URL once each. A request still
+        open in `open_requests` (queued or being fetched) gets the theme added to its list
+        instead of being yielded again, so its results reach every theme that needs it.
+        Requests are released from `open_requests` by the pipeline once handled; a theme
+        asking for one later sends it again, which the response cache usually serves.
+        Dedup therefore only spans the run's in-flight window: across runs, shared requests
+        are saved only while their response is in the cache (not with --no-cache or
+        --refresh-cache, nor after TTL expiry or LRU eviction).
+        """
+        shared = 0
+        for theme, params in self._interleave(themes):
+            subscribers = open_requests.get(params)
+            if subscribers is not None:
+                subscribers.append(theme)
+                shared += 1
                 continue
+            subscribers = open_requests[params] = [theme]
+            yield subscribers, params
+        if shared:
+            logging.info(f"{shared} search requests were shared between themes and fetched once.")
+
+    async def _run_pipeline(self, work: Iterable[tuple], total: Optional[int] = None, desc: str = "",
+                            on_done: Optional[Callable[[SearchParams], None]] = None,
+                            use_cache: bool = True) -> list:
+        """
+        Streams (themes, search parameters) pairs through a bounded pool of fetch workers.
+
+        Pairs are pulled lazily from the iterable, so the queue never holds more than a
+        couple of items per worker. Each result goes to every theme of its pair, and progress
+        counts one request per theme. Saturated windows are split and their halves re-queued
+        ahead of the bound, for the same themes. on_done is called with the params of each
+        pulled pair once it is handled. With use_cache False, responses are not served from
+        the response cache. Returns the pairs whose request failed.
+        """
+        worker_count = max(1, self.config.MAX_CONCURRENT_REQUESTS)
+        queue = asyncio.Queue()
+        producer_slots = asyncio.Semaphore(worker_count * 2)
+        failed = []
+        progress_bar = tqdm(total=total, desc=desc)
 
-            try:
-                batch_df = pd.concat(valid_results, ignore_index=True)
-                if not batch_df.empty:
-                    batch_df = batch_df.join(pd.json_normalize(batch_df["metadata"])).drop("metadata", axis=1)
-                    self._save_results(batch_df, process_id, i)
-            except Exception as e:
-                logging.error(f"Error processing or saving batch {i} for {process_id}: {e}")
-        
-        logging.info(f"--- Finished extraction for Process ID: {process_id} ---")
-
-    def _build_url(self, params):
-        keyword, direction, attachment, automated, start_day = params
-        end_day = start_day + 6
+        async def worker():
+            while True:
+                (themes, params), from_producer = await queue.get()
+                if from_producer:
+                    producer_slots.release()
+                try:
+                    result = await self._fetch_url(self._build_url(params), self._cache_ttl(params), use_cache)
+                    if not isinstance(result, pd.DataFrame):
+                        failed.append((themes, params))
+                        continue
+                    halves = self._split_if_saturated(params, result)
+                    if halves:
+                        for theme in themes:
+                            theme.on_split(params)
+                        progress_bar.total = (progress_bar.total or 0) + len(halves) * len(themes)
+                        for half in halves:
+                            queue.put_nowait(((themes, half), False))
+                    else:
+                        result = self._derive_facets(params, result)
+                        for theme in themes:
+                            theme.on_result(params, result)
+                except Exception as e:
+                    logging.error(f"Unexpected error while searching {params}: {e}")
+                    failed.append((themes, params))
+                finally:
+                    progress_bar.update(len(themes))
+                    if from_producer and on_done:
+                        on_done(params)
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(worker_count)]
+        try:
+            for item in work:
+                await producer_slots.acquire()
+                queue.put_nowait((item, True))
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            progress_bar.close()
+        return failed
+
+    async def _run_extraction(self, themes: List[ThemeExtraction]):
+        """Runs the searches of all themes through one shared pipeline."""
+        for theme in themes:
+            if theme.completed or theme.split:
+                logging.info(f"Resuming {theme.process_id}: {len(theme.completed)} search requests already completed.")
+        logging.info(f"--- Starting extraction for Process IDs: {', '.join(t.process_id for t in themes)} ---")
+
+        open_requests: Dict[SearchParams, list] = {}
+        failed = await self._run_pipeline(
+            self._plan_requests(themes, open_requests),
+            total=sum(theme.total for theme in themes),
+            desc=f"Searching {len(themes)} themes",
+            on_done=lambda params: open_requests.pop(params, None)
+        )
+        if failed:
+            logging.info(f"{len(failed)} requests failed, reloading cookies and retrying them...")
+            await self.client.reload_cookies_and_retry()
+            failed = await self._run_pipeline(
+                failed,
+                total=sum(len(themes_for_params) for themes_for_params, _ in failed),
+                desc="Retrying failed requests",
+                use_cache=False
+            )
+
+        for themes_for_params, params in failed:
+            for theme in themes_for_params:
+                theme.failed.append(params)
+        for theme in themes:
+            theme.flush()
+            if theme.failed:
+                self.error_log[theme.process_id] = [self._build_url(params) for params in theme.failed]
+            logging.info(f"--- Finished extraction for Process ID: {theme.process_id} ---")
+
+    def _build_url(self, params: SearchParams) -> str:
+        keyword, direction, attachment, automated, start_day, end_day = params
+        if direction == ALL_FACETS:
+            return (
+                f"{self.config.OSMOSE_BASE_URL}api/{self.config.MISSION_ID}/search?n=10000&sort=rel-desc"
+                f"&entitype=Voice&q={keyword}&daysSince1970={start_day},{end_day}"
+            )
         return (
             f"{self.config.OSMOSE_BASE_URL}api/{self.config.MISSION_ID}/search?n=10000&sort=rel-desc"
             f"&ext={direction}&entitype=Voice&q={keyword}&isAttachment={attachment}"
@@ -107,9 +439,14 @@ class MetadataExtractor:
         )
 
     def _save_results(self, df: pd.DataFrame, process_id: str, batch_number: int):
-        """Saves a DataFrame to a compressed CSV file."""
+        """Saves a DataFrame to a compressed CSV file, or a Parquet file in parquet output mode."""
         output_dir = os.path.join(self.config.OUTPUT_PATH_METADATA, process_id)
         os.makedirs(output_dir, exist_ok=True)
+        if self.config.METADATA_OUTPUT_FORMAT == "parquet":
+            outfile = os.path.join(output_dir, f'{batch_number}.parquet')
+            write_parquet(df, outfile, self.config.PARQUET_COMPRESSION)
+            logging.info(f"Saved results to {outfile}")
+            return
         outfile = os.path.join(output_dir, f'{batch_number}.csv.tar.gz')
         try:
             df.to_csv(outfile, index=False, encoding="utf-8-sig", escapechar='\\')
@@ -119,20 +456,27 @@ class MetadataExtractor:
         logging.info(f"Saved results to {outfile}")
 
     async def run(self, themes_df: pd.DataFrame):
-        """Orchestrates the extraction for all selected themes."""
+        """Orchestrates the extraction for all selected themes, interleaving their searches."""
         if themes_df.empty:
             return
-            
-        for _, theme in themes_df.iterrows():
-            process_id = str(theme['Process_ID'])
-            keywords = theme['keywords_full_list']
+
+        themes = []
+        for process_id, keywords in zip(themes_df['Process_ID'].astype(str), themes_df['keywords_full_list']):
             if not isinstance(keywords, list) or not keywords:
                 logging.warning(f"Skipping {process_id} due to missing or invalid keywords.")
                 continue
-            
-            await self._run_extraction_for_theme(process_id, keywords)
-        
+            theme = ThemeExtraction(self, process_id, keywords)
+            if not theme.total:
+                logging.warning(f"No search parameters generated for {process_id}. Skipping.")
+                continue
+            themes.append(theme)
+
+        if themes:
+            await self._run_extraction(themes)
+
         logging.info("Full metadata extraction process completed.")
+        if self.truncated:
+            logging.warning(f"{len(self.truncated)} single-day windows hit the result cap and may be truncated.")
         if self.error_log:
             logging.error("Errors occurred during extraction:")
             for process_id, errors in self.error_log.items():
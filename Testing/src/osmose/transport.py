@@ -0,0 +1,113 @@
+import logging
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from aiohttp import compression_utils
+from multidict import CIMultiDict
+
+from config import Config
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Connection-specific headers are forbidden in HTTP/2, and httpx negotiates encodings itself.
+_HTTPX_MANAGED_HEADERS = {"connection", "host", "keep-alive", "accept-encoding"}
+
+
+def _accepted_encodings() -> str:
+    """Returns the Accept-Encoding value aiohttp can actually decode with the installed packages."""
+    encodings = ["gzip", "deflate"]
+    if compression_utils.HAS_BROTLI:
+        encodings.append("br")
+    if getattr(compression_utils, "HAS_ZSTD", False):
+        encodings.append("zstd")
+    return ", ".join(encodings)
+
+
+class AiohttpTransport:
+    """
+    HTTP/1.1 transport on a single pooled aiohttp connector.
+
+    The connector caps connections per host at MAX_CONCURRENT_REQUESTS, caches DNS and keeps
+    idle connections alive between requests. aiohttp sets TCP_NODELAY on every connection.
+    """
+    def __init__(self, config: Config, cookies: Dict[str, str]):
+        connector = aiohttp.TCPConnector(
+            limit=config.MAX_CONCURRENT_REQUESTS,
+            limit_per_host=config.MAX_CONCURRENT_REQUESTS,
+            ttl_dns_cache=config.DNS_CACHE_TTL_SECONDS,
+            keepalive_timeout=config.KEEPALIVE_TIMEOUT_SECONDS
+        )
+        headers = dict(config.REQUEST_HEADERS)
+        headers["Accept-Encoding"] = _accepted_encodings()
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            headers=headers,
+            cookies=cookies,
+            timeout=aiohttp.ClientTimeout(total=config.REQUEST_TIMEOUT_SECONDS)
+        )
+
+    async def get(self, url: str, timeout: Optional[float] = None) -> Tuple[int, CIMultiDict, bytes]:
+        kwargs = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        async with self._session.get(url, **kwargs) as response:
+            body = await response.read()
+            return response.status, CIMultiDict(response.headers), body
+
+    def update_cookies(self, cookies: Dict[str, str]):
+        self._session.cookie_jar.clear()
+        self._session.cookie_jar.update_cookies(cookies)
+
+    async def close(self):
+        await self._session.close()
+
+
+class HttpxTransport:
+    """HTTP/2 transport using httpx, multiplexing all requests over a few connections."""
+    def __init__(self, config: Config, cookies: Dict[str, str]):
+        headers = {
+            name: value for name, value in config.REQUEST_HEADERS.items()
+            if name.lower() not in _HTTPX_MANAGED_HEADERS
+        }
+        self._client = httpx.AsyncClient(
+            http2=True,
+            headers=headers,
+            cookies=cookies,
+            timeout=config.REQUEST_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=config.MAX_CONCURRENT_REQUESTS,
+                max_keepalive_connections=config.MAX_CONCURRENT_REQUESTS,
+                keepalive_expiry=config.KEEPALIVE_TIMEOUT_SECONDS
+            )
+        )
+
+    async def get(self, url: str, timeout: Optional[float] = None) -> Tuple[int, CIMultiDict, bytes]:
+        """Returns (status, headers, body); httpx lowercases header names, so they are case-insensitive."""
+        try:
+            response = await self._client.get(url, timeout=timeout or httpx.USE_CLIENT_DEFAULT)
+        except httpx.TimeoutException as e:
+            # Callers treat asyncio timeouts as server overload, whatever the backend.
+            raise aiohttp.ServerTimeoutError(str(e)) from e
+        except httpx.TransportError as e:
+            raise aiohttp.ClientConnectionError(str(e)) from e
+        return response.status_code, CIMultiDict(response.headers.multi_items()), response.content
+
+    def update_cookies(self, cookies: Dict[str, str]):
+        self._client.cookies.clear()
+        self._client.cookies.update(cookies)
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def create_transport(config: Config, cookies: Dict[str, str]):
+    """Creates the transport selected by HTTP_BACKEND, falling back to aiohttp."""
+    if config.HTTP_BACKEND == "httpx":
+        try:
+            if httpx is None:
+                raise ImportError("httpx is not installed")
+            return HttpxTransport(config, cookies)
+        except ImportError as e:  # httpx raises it too when the h2 package is missing
+            logging.warning(f"HTTP_BACKEND is 'httpx' but it is unavailable ({e}), falling back to aiohttp.")
+    return AiohttpTransport(config, cookies)
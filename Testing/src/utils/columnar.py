@@ -0,0 +1,100 @@
+import json
+import logging
+from typing import List, Tuple
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+HAS_PYARROW = pa is not None
+
+
+def _stringify(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, float) and pd.isna(value):
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return str(value)
+
+
+def to_arrow_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts object columns to plain strings so every batch maps to a stable Arrow schema.
+
+    Search results mix types within a column (numbers, strings, nested lists), which Arrow
+    rejects; the CSV output stringified these values anyway.
+    """
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].map(_stringify)
+    return df
+
+
+def write_parquet(df: pd.DataFrame, path: str, compression: str = "zstd"):
+    """Writes a DataFrame to a single Parquet file."""
+    pq.write_table(pa.Table.from_pandas(to_arrow_safe(df), preserve_index=False), path, compression=compression)
+
+
+def _unified_schema(schemas: list) -> "pa.Schema":
+    """
+    Merges the batch files' schemas field by field, in order of first appearance.
+
+    Types are unified as pyarrow permits (null and numeric promotion); a field whose types
+    cannot be unified, e.g. int64 in one batch and strings in another, becomes a string.
+    """
+    field_types = {}
+    for schema in schemas:
+        for field in schema:
+            field_types.setdefault(field.name, []).append(field.type)
+    fields = []
+    for name, types in field_types.items():
+        try:
+            field = pa.unify_schemas(
+                [pa.schema([pa.field(name, field_type)]) for field_type in types], promote_options="permissive"
+            ).field(name)
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            logging.info(f"Field {name} has incompatible types {sorted(set(map(str, types)))}, storing it as strings.")
+            field = pa.field(name, pa.large_string())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _conform(batch: "pa.RecordBatch", schema: "pa.Schema") -> list:
+    """Returns the batch's columns cast to the schema, with nulls for the fields it lacks."""
+    columns = []
+    for field in schema:
+        index = batch.schema.get_field_index(field.name)
+        if index < 0:
+            columns.append(pa.nulls(batch.num_rows, field.type))
+        else:
+            columns.append(batch.column(index).cast(field.type))
+    return columns
+
+
+def consolidate_parquet(files: List[Tuple[str, str]], output_path: str, compression: str = "zstd") -> int:
+    """
+    Streams (process_id, path) Parquet files into one Parquet file with a Process_ID column.
+
+    The files are read record batch by record batch, cast to a unified schema and written
+    out, so memory use does not depend on the total size. Returns the row count.
+    """
+    schema = _unified_schema([pq.read_schema(path) for _, path in files])
+    output_schema = pa.schema([pa.field("Process_ID", pa.string())] + list(schema))
+
+    rows = 0
+    with pq.ParquetWriter(output_path, output_schema, compression=compression) as writer:
+        for process_id, path in files:
+            for batch in pq.ParquetFile(path).iter_batches():
+                process_ids = pa.array([process_id] * batch.num_rows, pa.string())
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [process_ids] + _conform(batch, schema), schema=output_schema
+                ))
+                rows += batch.num_rows
+    logging.info(f"Consolidated {rows} rows from {len(files)} Parquet files.")
+    return rows
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header (delay in seconds or HTTP date) into seconds from now."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrencyController:
+    """
+    AIMD concurrency window driven by server feedback.
+
+    The window grows by roughly one request per window's worth of fast responses and is
+    halved on 429, 5xx or timeouts (at most once per cooldown, so a burst of failures
+    counts as one congestion event). A Retry-After header pauses all new requests.
+    """
+    def __init__(self, initial: int, minimum: int, maximum: int, target_latency: float,
+                 backoff_factor: float = 0.5, cooldown: float = 2.0):
+        self._minimum = max(1, minimum)
+        self._maximum = max(self._minimum, maximum)
+        self._target_latency = target_latency
+        self._backoff_factor = backoff_factor
+        self._cooldown = cooldown
+        self.limit = float(min(max(initial, self._minimum), self._maximum))
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        """Waits for a free slot in the current window and for any Retry-After pause to end."""
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._condition:
+                await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+                if self._paused_until <= time.monotonic():
+                    self._in_flight += 1
+                    return
+
+    async def release(self, latency: Optional[float] = None, overloaded: bool = False,
+                      retry_after: Optional[float] = None):
+        """Frees a slot and adjusts the window from the outcome of the request."""
+        async with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+                logging.warning(f"Server asked to retry after {retry_after:.1f}s, pausing new requests.")
+            if overloaded:
+                if now - self._last_decrease >= self._cooldown:
+                    self.limit = max(self._minimum, self.limit * self._backoff_factor)
+                    self._last_decrease = now
+                    logging.info(f"Server overloaded, reducing concurrency to {int(self.limit)}.")
+            elif latency is not None and latency <= self._target_latency:
+                self.limit = min(self._maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    @staticmethod
+    def retry_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+        """Exponential backoff with full jitter, so retries from many tasks do not line up."""
+        return random.uniform(0, min(cap, base * 2 ** attempt))
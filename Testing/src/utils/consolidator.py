@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+
+class StreamingConsolidator:
+    """
+    Incrementally consolidates metadata batch CSV files into a single CSV in bounded memory.
+
+    Batch files are read by a thread pool, at most a few ahead of the writer, and appended to
+    the output in a stable order. A SQLite state file remembers which batch files have been
+    consolidated, the output columns and the dedup keys already written, so each run only
+    processes new batch files and never writes the same message twice.
+    """
+    def __init__(self, source_dir: str, output_path: str, state_path: str,
+                 dedup_keys: Optional[List[str]] = None, read_workers: int = 4,
+                 file_suffix: str = ".csv.tar.gz"):
+        self._source_dir = source_dir
+        self._output_path = output_path
+        self._state_path = state_path
+        self._dedup_keys = dedup_keys or []
+        self._read_workers = max(1, read_workers)
+        self._file_suffix = file_suffix
+
+    def _batch_files(self) -> List[Tuple[str, str]]:
+        """Returns (process_id, path) for every batch file, in process and batch order."""
+        def batch_order(file_name):
+            match = re.match(r"\d+", file_name)
+            return (int(match.group()) if match else float("inf"), file_name)
+
+        files = []
+        for process_folder in sorted(os.listdir(self._source_dir)):
+            process_path = os.path.join(self._source_dir, process_folder)
+            if not os.path.isdir(process_path):
+                continue
+            for file in sorted(os.listdir(process_path), key=batch_order):
+                if file.endswith(self._file_suffix):
+                    files.append((process_folder, os.path.join(process_path, file)))
+        return files
+
+    def _open_state(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._state_path)
+        conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        return conn
+
+    def _reset(self, conn: sqlite3.Connection):
+        conn.execute("DELETE FROM files")
+        conn.execute("DELETE FROM seen")
+        conn.execute("DELETE FROM meta")
+        conn.commit()
+        if os.path.exists(self._output_path):
+            os.remove(self._output_path)
+
+    @staticmethod
+    def _read(path: str, columns_only: bool = False) -> pd.DataFrame:
+        return pd.read_csv(
+            path, encoding="utf-8-sig", dtype=str, keep_default_na=False,
+            nrows=0 if columns_only else None
+        )
+
+    def _drop_seen(self, conn: sqlite3.Connection, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Drops rows whose dedup key was already written, and records the new keys.
+
+        Rows with a blank key part (e.g. an empty msgId) identify nothing and are always kept.
+        """
+        if not self._dedup_keys or not set(self._dedup_keys) <= set(df.columns):
+            return df
+        parts = [df[key].fillna("").astype(str) for key in self._dedup_keys]
+        blank = pd.concat([part.str.strip() == "" for part in parts], axis=1).any(axis=1)
+        first, *rest = parts
+        keys = first.str.cat(rest, sep="\x1f") if rest else first
+        keys = keys[~blank]
+        keys = keys[~keys.duplicated()]
+
+        seen = set()
+        candidates = keys.tolist()
+        for start in range(0, len(candidates), 900):
+            chunk = candidates[start:start + 900]
+            placeholders = ",".join("?" * len(chunk))
+            seen.update(row[0] for row in conn.execute(f"SELECT key FROM seen WHERE key IN ({placeholders})", chunk))
+        new = keys[~keys.isin(seen)]
+        conn.executemany("INSERT INTO seen (key) VALUES (?)", ((key,) for key in new))
+        return df[blank | df.index.isin(new.index)]
+
+    def run(self) -> int:
+        """Appends all new batch files to the output and returns the number of rows written."""
+        conn = self._open_state()
+        try:
+            return self._run(conn)
+        finally:
+            conn.close()
+
+    def _run(self, conn: sqlite3.Connection) -> int:
+        if not os.path.exists(self._output_path):
+            self._reset(conn)
+        done = {path: (size, mtime) for path, size, mtime in conn.execute("SELECT path, size, mtime FROM files")}
+        stored_columns = conn.execute("SELECT value FROM meta WHERE name = 'columns'").fetchone()
+        columns = json.loads(stored_columns[0]) if stored_columns else ["Process_ID"]
+
+        def is_new(path):
+            stat = os.stat(path)
+            return done.get(path) != (stat.st_size, stat.st_mtime)
+
+        new_files = [(process_id, path) for process_id, path in self._batch_files() if is_new(path)]
+        if not new_files:
+            logging.info("No new batch files to consolidate.")
+            return 0
+
+        added_columns = []
+        for _, path in new_files:
+            for column in self._read(path, columns_only=True).columns:
+                if column not in columns and column not in added_columns:
+                    added_columns.append(column)
+        if added_columns and os.path.exists(self._output_path):
+            # The existing output's header lacks these columns, so it has to be rebuilt.
+            logging.info(f"New columns {added_columns} found, rebuilding the consolidated file.")
+            self._reset(conn)
+            return self._run(conn)
+        columns += added_columns
+        conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('columns', ?)", (json.dumps(columns),))
+
+        resume = os.path.exists(self._output_path) and os.path.getsize(self._output_path) > 0
+        rows_written = 0
+        with ThreadPoolExecutor(max_workers=self._read_workers) as pool, open(
+            self._output_path, "a" if resume else "w", newline="",
+            encoding="utf-8" if resume else "utf-8-sig"
+        ) as output:
+            write_header = not resume
+            pending = deque()
+            files = iter(new_files)
+
+            def submit_next():
+                for process_id, path in files:
+                    pending.append((process_id, path, pool.submit(self._read, path)))
+                    return
+
+            for _ in range(self._read_workers * 2):
+                submit_next()
+            while pending:
+                process_id, path, future = pending.popleft()
+                submit_next()
+                try:
+                    df = future.result()
+                except Exception as e:
+                    logging.error(f"Error reading {path}: {e}")
+                    continue
+                df.insert(0, "Process_ID", process_id)
+                df = self._drop_seen(conn, df.reindex(columns=columns, fill_value=""))
+                df.to_csv(output, index=False, header=write_header, escapechar='\\')
+                output.flush()
+                write_header = False
+                rows_written += len(df)
+                stat = os.stat(path)
+                conn.execute("INSERT OR REPLACE INTO files (path, size, mtime) VALUES (?, ?, ?)",
+                             (path, stat.st_size, stat.st_mtime))
+                conn.commit()
+                logging.info(f"Added file {path} for Process_ID {process_id}")
+        return rows_written
@@ -1,16 +1,68 @@
 import asyncio
 import logging
-from playwright.async_api import async_playwright
+from urllib.parse import urlsplit
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 from playwright.sync_api import sync_playwright
-from typing import Dict
+from typing import Any, Dict, List, Optional, Tuple
 
 class AsyncCookieManager:
     """Manages authentication cookies using Playwright asynchronously."""
-    def __init__(self, url: str):
+    def __init__(self, url: str, required_cookies: Optional[List[str]] = None,
+                 ready_timeout: float = 30, poll_interval: float = 0.5, settle_time: float = 5):
         self._url = url
+        self._required_cookies = set(required_cookies or [])
+        self._ready_timeout = ready_timeout
+        self._poll_interval = poll_interval
+        self._settle_time = settle_time
+
+    async def _wait_for_cookies(self, context, page) -> Tuple[list, bool]:
+        """
+        Polls the browser cookie jar until authentication has completed.
+
+        Returns the cookies and whether they passed the readiness check before the timeout.
+
+        Ready means all required cookies are present or, when none are configured, that the
+        page has gone network-idle back on the OSMOSE host and a non-empty set of cookie
+        names has not changed for settle_time seconds (so login redirects have finished).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._ready_timeout
+        if not self._required_cookies:
+            try:
+                await page.wait_for_load_state("networkidle", timeout=self._ready_timeout * 1000)
+            except PlaywrightTimeoutError:
+                logging.warning("Login page did not reach network idle, waiting on cookies only.")
+        target_host = urlsplit(self._url).hostname
+        previous_names = None
+        stable_since = loop.time()
+        while True:
+            cookies = await context.cookies()
+            names = {cookie['name'] for cookie in cookies}
+            if self._required_cookies:
+                ready = self._required_cookies <= names
+            else:
+                if names != previous_names:
+                    stable_since = loop.time()
+                ready = (bool(names) and urlsplit(page.url).hostname == target_host
+                         and loop.time() - stable_since >= self._settle_time)
+            if ready:
+                return cookies, True
+            if loop.time() >= deadline:
+                logging.warning(f"Cookies not ready after {self._ready_timeout}s, using what is available.")
+                return cookies, False
+            previous_names = names
+            await asyncio.sleep(self._poll_interval)
 
     async def reload(self) -> Dict[str, str]:
         """Launches Edge using Playwright to fetch fresh authentication cookies."""
+        cookies, _ = await self.fetch_cookies()
+        return {cookie['name']: cookie['value'] for cookie in cookies}
+
+    async def fetch_cookies(self) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Like reload, but returns the full Playwright cookies, including their expiry times,
+        and whether they passed the readiness check.
+        """
         logging.info("Reloading authentication cookies...")
         async with async_playwright() as p:
             try:
@@ -18,12 +70,10 @@ class AsyncCookieManager:
                 context = await browser.new_context(ignore_https_errors=True)
                 page = await context.new_page()
                 await page.goto(self._url)
-                await asyncio.sleep(15)
-                cookies = await context.cookies()
-                cookies_dict = {cookie['name']: cookie['value'] for cookie in cookies}
+                cookies, ready = await self._wait_for_cookies(context, page)
                 await browser.close()
                 logging.info("Cookies reloaded successfully.")
-                return cookies_dict
+                return cookies, ready
             except Exception as e:
                 logging.error(f"Failed to reload cookies with Playwright: {e}")
                 raise
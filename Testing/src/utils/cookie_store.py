@@ -0,0 +1,68 @@
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+class CookieStore:
+    """
+    Persists authentication cookies and their expiry times between runs.
+
+    The file is created readable by the current user only (on Windows, where POSIX modes
+    are not enforced, it inherits the permissions of the user's project folder).
+    Only the authentication cookies count towards the expiry: those named in auth_names or,
+    if none are given, those set for the host of site_url. Short-lived IdP or load-balancer
+    cookies would otherwise force a browser relaunch long before the session ends.
+    """
+    def __init__(self, path: str, session_ttl: float, site_url: str = "",
+                 auth_names: Optional[List[str]] = None):
+        self._path = path
+        self._session_ttl = session_ttl
+        self._host = (urlsplit(site_url).hostname or "").lower()
+        self._auth_names = set(auth_names or [])
+
+    def _is_auth_cookie(self, cookie: Dict[str, Any]) -> bool:
+        if self._auth_names:
+            return cookie.get('name') in self._auth_names
+        domain = str(cookie.get('domain', '')).lstrip('.').lower()
+        return bool(domain) and (self._host == domain or self._host.endswith(f".{domain}"))
+
+    def expires_at(self, cookies: List[Dict[str, Any]], saved_at: float) -> float:
+        """
+        Returns when the first authentication cookie expires (all cookies if none match);
+        session cookies last session_ttl from saved_at.
+        """
+        session_expiry = saved_at + self._session_ttl
+        auth_cookies = [cookie for cookie in cookies if self._is_auth_cookie(cookie)] or cookies
+        expiries = [
+            cookie['expires'] if cookie.get('expires', -1) > 0 else session_expiry
+            for cookie in auth_cookies
+        ]
+        return min(expiries, default=saved_at)
+
+    def load(self) -> Optional[Tuple[Dict[str, str], float]]:
+        """Returns the stored cookies and their expiry time, or None if nothing usable is stored."""
+        try:
+            with open(self._path, "r", encoding="utf-8") as store_file:
+                stored = json.load(store_file)
+            cookies = stored["cookies"]
+            expires_at = self.expires_at(cookies, stored["saved_at"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Ignoring unreadable cookie store {self._path}: {e}")
+            return None
+        return {cookie['name']: cookie['value'] for cookie in cookies}, expires_at
+
+    def save(self, cookies: List[Dict[str, Any]]) -> float:
+        """Stores the cookies atomically and returns their expiry time."""
+        saved_at = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        temp_path = f"{self._path}.tmp"
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w", encoding="utf-8") as store_file:
+            json.dump({"saved_at": saved_at, "cookies": cookies}, store_file)
+        os.replace(temp_path, self._path)
+        return self.expires_at(cookies, saved_at)
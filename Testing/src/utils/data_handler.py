@@ -1,25 +1,53 @@
 import logging
 import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
 import pandas as pd
 
 from config import Config
+from src.utils.columnar import consolidate_parquet
+from src.utils.consolidator import StreamingConsolidator
 
 class DataHandler:
     """
     Handles data loading, preprocessing, and consolidation.
     """
+    # Input columns the content extraction uses; everything else is skipped when reading lazily.
+    CONTENT_INPUT_COLUMNS = [
+        "epoch", "isAttachment", "entityType", "Title", "Title_eng", "msgId", "lot", "u",
+        "DATE", "Keyword", "extension",
+    ]
+
     def __init__(self, config: Config):
         self.config = config
 
-    def _to_list(self, text):
-        """Helper to convert comma-separated string to a list of terms."""
-        try:
-            if pd.notna(text) and text != "N/A":
-                items = [item.strip().replace(" ", "+").replace("“", "+") for item in text.split(',')]
-                return [item for item in items if item]
-            return "N/A"
-        except Exception:
-            return "N/A"
+    @staticmethod
+    def _split_terms(series: pd.Series, sep: str, replacements: list, missing,
+                     valid: Optional[pd.Series] = None) -> pd.Series:
+        """
+        Splits each string into a list of stripped, non-empty terms, column-wise.
+
+        Terms are exploded into one long Series, cleaned with vectorized string operations
+        and grouped back per row. Rows not marked in `valid` (by default, NaN rows) get
+        `missing` instead.
+        """
+        if valid is None:
+            valid = series.notna()
+        terms = series[valid].astype(str).str.split(sep).explode().str.strip()
+        for old, new in replacements:
+            terms = terms.str.replace(old, new, regex=False)
+        grouped = terms[terms != ""].groupby(level=0).agg(list)
+
+        return pd.Series([
+            terms if isinstance(terms, list) else [] if is_valid else missing
+            for terms, is_valid in zip(grouped.reindex(series.index).tolist(), valid.tolist())
+        ], index=series.index, dtype=object)
+
+    def _to_list(self, series: pd.Series) -> pd.Series:
+        """Helper to convert comma-separated strings to lists of terms ("N/A" for "N/A" and non-strings)."""
+        is_text = series.map(lambda value: isinstance(value, str))
+        return self._split_terms(series, ',', [(" ", "+"), ("“", "+")], "N/A", valid=is_text & (series != "N/A"))
 
     def load_and_process_metadata_input(self) -> pd.DataFrame:
         """
@@ -32,16 +60,12 @@ class DataHandler:
             logging.error(f"Error: Input file not found at {self.config.INPUT_FILE_METADATA}")
             return pd.DataFrame()
 
-        df['keywords_full_list'] = df['OSMOSE key words full'].apply(
-            lambda x: [item.strip().replace(" “", "+") for item in x.split(' ')] if pd.notna(x) else []
-        )
-        df['keywords_full_list'] = df['keywords_full_list'].apply(
-            lambda x: [item for item in x if item]
-        )
-        
-        df['keywords_in_title_list'] = df['OSMOSE key words in title'].apply(self._to_list)
-        df['sender_criteria_list'] = df['OSMOSE Sender criteria'].apply(self._to_list)
-        df['recipient_criteria_list'] = df['OSMOSE Recipient criteria'].apply(self._to_list)
+        full_keywords = df['OSMOSE key words full'].where(df['OSMOSE key words full'].notna(), "")
+        df['keywords_full_list'] = self._split_terms(full_keywords, ' ', [(" “", "+")], [])
+
+        df['keywords_in_title_list'] = self._to_list(df['OSMOSE key words in title'])
+        df['sender_criteria_list'] = self._to_list(df['OSMOSE Sender criteria'])
+        df['recipient_criteria_list'] = self._to_list(df['OSMOSE Recipient criteria'])
 
         selected_themes = df[df['Selected'] == "Y"].copy()
         
@@ -69,60 +93,158 @@ class DataHandler:
         non_emails_df = df[~email_mask]
         
         processed_df = pd.concat([non_emails_df, emails_df], ignore_index=True)
-        processed_df['URL'] = processed_df.apply(
-            lambda row: self._generate_url(row, self.config.OSMOSE_BASE_URL, self.config.MISSION_ID),
-            axis=1
-        )
+        processed_df['URL'] = self._generate_urls(processed_df, self.config.OSMOSE_BASE_URL, self.config.MISSION_ID)
         return processed_df
 
-    def _generate_url(self, row: pd.Series, base_url: str, mission_id: str) -> str:
-        """Generate the appropriate URL for a given dataset row."""
-        if row.get("isAttachment"):
-            return f'{base_url}{"api"}/{row["u"]}'
-        
-        entity_type = row.get("entityType")
-        msg_id = row.get("msgId")
-        lot = row.get("lot")
-
-        if entity_type == "Email":
-            return f"{base_url}api/{mission_id}/eml-embed/{lot}/{msg_id}/Email.txt?highlight=queue="
-        elif entity_type == "Voice":
-            return f"{base_url}api/{mission_id}/vox/{msg_id}/"
-        elif entity_type == "Chat":
-            return f"{base_url}api/{mission_id}/bbg/{msg_id}/Chat.txt?"
+    def _read_content_chunks(self, columns: List[str]) -> Iterator[pd.DataFrame]:
+        """Reads the content input CSV in chunks, projecting the given columns with compact dtypes."""
+        dtypes = {
+            "entityType": "category",
+            "Keyword": "category",
+            "epoch": "Int64",
+            "msgId": str,
+            "lot": str,
+            "u": str,
+        }
+        return pd.read_csv(
+            self.config.INPUT_FILE_CONTENT,
+            usecols=lambda column: column in columns,
+            dtype={column: dtype for column, dtype in dtypes.items() if column in columns},
+            chunksize=self.config.CONTENT_INPUT_CHUNK_ROWS
+        )
+
+    @staticmethod
+    def _title_keys(titles: pd.Series) -> pd.Series:
+        # NaN titles are one group for drop_duplicates, but NaN never equals itself as a dict key.
+        return titles.astype(object).where(titles.notna(), "\x00<no title>")
+
+    def iter_content_input(self) -> Tuple[int, Iterator[pd.DataFrame]]:
+        """
+        Lazy counterpart of load_and_process_content_input, for inputs too large to load at once.
+
+        A first pass over the CSV keeps only a "latest epoch per Title" index for emails. The
+        second pass yields the same rows load_and_process_content_input would keep, chunk by
+        chunk, with their URL: the latest email per Title or, for a Title whose emails all lack
+        an epoch, its first one. Returns (row count, chunk iterator).
+        """
+        try:
+            latest_epoch: Dict[Any, int] = {}
+            undated_titles = set()
+            other_rows = 0
+            for chunk in self._read_content_chunks(["epoch", "isAttachment", "entityType", "Title"]):
+                chunk = chunk[chunk['isAttachment'] != True]
+                email_mask = chunk['entityType'] == 'Email'
+                other_rows += int((~email_mask).sum())
+                emails = chunk[email_mask]
+                dated = emails['epoch'].notna()
+                undated_titles.update(self._title_keys(emails.loc[~dated, 'Title']))
+                emails = emails[dated]
+                chunk_latest = emails.groupby(self._title_keys(emails['Title']), sort=False)['epoch'].max()
+                for title, epoch in chunk_latest.items():
+                    if title not in latest_epoch or epoch > latest_epoch[title]:
+                        latest_epoch[title] = epoch
+        except FileNotFoundError:
+            logging.error(f"Error: Input CSV file not found at {self.config.INPUT_FILE_CONTENT}")
+            return 0, iter(())
+        except Exception as e:
+            logging.error(f"Error reading CSV file: {e}")
+            return 0, iter(())
+
+        def chunks() -> Iterator[pd.DataFrame]:
+            emitted_titles = set()
+            for chunk in self._read_content_chunks(self.CONTENT_INPUT_COLUMNS):
+                chunk = chunk[chunk['isAttachment'] != True]
+                email_mask = chunk['entityType'] == 'Email'
+                title_keys = self._title_keys(chunk['Title'])
+                is_latest = chunk['epoch'].eq(title_keys.map(latest_epoch).astype("Int64")).fillna(False)
+                undated = ~title_keys.isin(latest_epoch.keys())
+                keep = ~email_mask | ((is_latest | undated) & ~title_keys.isin(emitted_titles))
+                chunk, title_keys, email_mask = chunk[keep], title_keys[keep], email_mask[keep]
+                # Several emails of one chunk can share the latest epoch (or have none); keep the first.
+                duplicated = email_mask & title_keys.where(email_mask).duplicated()
+                chunk, title_keys, email_mask = chunk[~duplicated], title_keys[~duplicated], email_mask[~duplicated]
+                emitted_titles.update(title_keys[email_mask])
+
+                chunk = chunk.assign(
+                    **{'Converted Date': pd.to_datetime(chunk['epoch'], unit='s')},
+                    URL=self._generate_urls(chunk, self.config.OSMOSE_BASE_URL, self.config.MISSION_ID)
+                )
+                yield chunk
+
+        undated_titles.difference_update(latest_epoch)
+        return other_rows + len(latest_epoch) + len(undated_titles), chunks()
+
+    @staticmethod
+    def _generate_urls(df: pd.DataFrame, base_url: str, mission_id: str) -> pd.Series:
+        """Generates the appropriate URL for every row, with column-wise string operations."""
+        def column(name):
+            # Formatted like an f-string would: missing values become "nan", absent columns "None".
+            if name not in df.columns:
+                return pd.Series("None", index=df.index)
+            return df[name].astype(str).fillna("nan")
+
+        msg_id, lot, u = column("msgId"), column("lot"), column("u")
+        entity_type = column("entityType")
+        # Truthiness as in a plain `if row["isAttachment"]`: NaN counts as true.
+        if "isAttachment" in df.columns:
+            is_attachment = df["isAttachment"].astype(bool)
         else:
-            return ""
+            is_attachment = pd.Series(False, index=df.index)
+
+        api = f"{base_url}api/{mission_id}/"
+        conditions = [
+            is_attachment,
+            entity_type == "Email",
+            entity_type == "Voice",
+            entity_type == "Chat",
+        ]
+        choices = [
+            f"{base_url}api/" + u,
+            api + "eml-embed/" + lot + "/" + msg_id + "/Email.txt?highlight=queue=",
+            api + "vox/" + msg_id + "/",
+            api + "bbg/" + msg_id + "/Chat.txt?",
+        ]
+        return pd.Series(np.select(conditions, choices, default=""), index=df.index, dtype=object)
+
+    def _consolidate_parquet(self):
+        """Streams all Parquet batch files from Process_ID subfolders into a single Parquet file."""
+        autosearch_dir = self.config.OUTPUT_PATH_METADATA
+        files = [
+            (process_folder, os.path.join(autosearch_dir, process_folder, file))
+            for process_folder in sorted(os.listdir(autosearch_dir))
+            if os.path.isdir(os.path.join(autosearch_dir, process_folder))
+            for file in sorted(os.listdir(os.path.join(autosearch_dir, process_folder)))
+            if file.endswith(".parquet")
+        ]
+        if not files:
+            logging.warning("No Parquet files found for consolidation.")
+            return
+
+        consolidated_output_path = os.path.join(autosearch_dir, "consolidated_Auto_Search.parquet")
+        consolidate_parquet(files, consolidated_output_path, self.config.PARQUET_COMPRESSION)
+        logging.info(f"Consolidated file saved at: {consolidated_output_path}")
 
     def consolidate_results(self):
         """
-        Consolidates all generated CSV files from Process_ID subfolders into a single file.
+        Consolidates all generated batch files from Process_ID subfolders into a single file.
+
+        CSV batches are appended incrementally: only batch files added since the last
+        consolidation are read, and messages already written are skipped.
         """
         logging.info("Starting consolidation of result files...")
-        consolidated_list = []
-        autosearch_dir = self.config.OUTPUT_PATH_METADATA
+        if self.config.METADATA_OUTPUT_FORMAT == "parquet":
+            self._consolidate_parquet()
+            return
 
-        for process_folder in os.listdir(autosearch_dir):
-            process_path = os.path.join(autosearch_dir, process_folder)
-            if os.path.isdir(process_path):
-                for file in os.listdir(process_path):
-                    if file.endswith(".csv.tar.gz"):
-                        file_path = os.path.join(process_path, file)
-                        try:
-                            df = pd.read_csv(file_path, encoding="utf-8-sig")
-                            df['Process_ID'] = process_folder
-                            consolidated_list.append(df)
-                            logging.info(f"Added file {file_path} for Process_ID {process_folder}")
-                        except Exception as e:
-                            logging.error(f"Error reading {file_path}: {e}")
-        
-        if consolidated_list:
-            consolidated_df = pd.concat(consolidated_list, ignore_index=True)
-            if 'Process_ID' in consolidated_df.columns:
-                columns = ['Process_ID'] + [col for col in consolidated_df.columns if col != 'Process_ID']
-                consolidated_df = consolidated_df[columns]
-
-            consolidated_output_path = os.path.join(autosearch_dir, "consolidated_Auto_Search.csv.tar.gz")
-            consolidated_df.to_csv(consolidated_output_path, index=False, encoding="utf-8-sig", escapechar='\\')
-            logging.info(f"Consolidated file saved at: {consolidated_output_path}")
-        else:
-            logging.warning("No CSV files found for consolidation.") 
\ No newline at end of file
+        autosearch_dir = self.config.OUTPUT_PATH_METADATA
+        consolidated_output_path = os.path.join(autosearch_dir, "consolidated_Auto_Search.csv")
+        consolidator = StreamingConsolidator(
+            autosearch_dir,
+            consolidated_output_path,
+            self.config.CONSOLIDATION_STATE_PATH,
+            dedup_keys=self.config.CONSOLIDATION_DEDUP_KEYS,
+            read_workers=self.config.CONSOLIDATION_READ_WORKERS
+        )
+        rows_written = consolidator.run()
+        if rows_written:
+            logging.info(f"Appended {rows_written} rows to consolidated file: {consolidated_output_path}")
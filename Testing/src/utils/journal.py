@@ -0,0 +1,51 @@
+import json
+import logging
+import os
+from typing import Any, Dict, List
+
+
+class ExtractionJournal:
+    """
+    Append-only JSON-lines journal of completed work units.
+
+    Each finished unit is written as one line and flushed immediately, so an interrupted
+    run can be resumed by skipping everything already recorded. A partially written last
+    line (e.g. after a crash) is ignored on load.
+    """
+    def __init__(self, path: str):
+        self._path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.entries: List[Dict[str, Any]] = self._load()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _load(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self._path):
+            return []
+        entries = []
+        with open(self._path, "r", encoding="utf-8") as journal_file:
+            for line_number, line in enumerate(journal_file, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning(f"Ignoring malformed line {line_number} in journal {self._path}")
+        if entries:
+            logging.info(f"Loaded {len(entries)} completed units from journal {self._path}")
+        return entries
+
+    def record(self, **entry):
+        """Appends a completed unit to the journal."""
+        self._file.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+        self.entries.append(entry)
+
+    def reset(self):
+        """Discards all recorded units, so the next run starts from scratch."""
+        self._file.close()
+        self._file = open(self._path, "w", encoding="utf-8")
+        self.entries = []
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,60 @@
+import json
+from typing import Any, Dict, List
+
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+elif msgspec is not None:
+    JSON_BACKEND = "msgspec"
+    _msgspec_decoder = msgspec.json.Decoder()
+else:
+    JSON_BACKEND = "json"
+
+
+def loads(data: bytes) -> Any:
+    """
+    Decodes a JSON document with the fastest available parser (orjson, msgspec, then json).
+
+    Every backend raises json.JSONDecodeError on invalid input.
+    """
+    if JSON_BACKEND == "orjson":
+        return orjson.loads(data)  # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    if JSON_BACKEND == "msgspec":
+        try:
+            return _msgspec_decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise json.JSONDecodeError(str(e), "", 0) from e
+    return json.loads(data)
+
+
+def records_to_frame(records: List[Dict[str, Any]], nested: str = "metadata") -> pd.DataFrame:
+    """
+    Builds the DataFrame of a list of search result records in one step.
+
+    The records are converted with pandas' C record conversion and the `nested` dicts
+    flattened by pd.json_normalize, whose columns follow the record's own as the old join
+    over each saved batch placed them. Column names, order and values are json_normalize's.
+    """
+    if not records:
+        return pd.DataFrame()
+    df = pd.DataFrame.from_records(records)
+    if nested not in df.columns:
+        return df
+    fields = pd.json_normalize(
+        [record.get(nested) if isinstance(record.get(nested), dict) else {} for record in records]
+    )
+    fields.index = df.index
+    # On a name clash the nested value wins, as the record's own field would make the join fail.
+    df = df.drop(columns=[nested, *(column for column in fields.columns if column in df.columns)])
+    return pd.concat([df, fields], axis=1)
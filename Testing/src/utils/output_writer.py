@@ -0,0 +1,70 @@
+import csv
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+import pandas as pd
+from openpyxl import Workbook
+
+
+class ContentOutputWriter:
+    """
+    Streams content result rows to a tab-separated CSV file as they complete.
+
+    Rows are buffered and written in chunks, so memory use stays flat regardless of
+    the number of rows. The Excel export is built afterwards by reading the CSV back
+    in chunks into a write-only workbook.
+    """
+    COLUMNS = ["DATE", "Keyword", "msgId", "isAttachment", "Title", "Extension", "URL", "HTML File Path", "Content"]
+
+    def __init__(self, csv_path: str, chunk_rows: int = 500, append: bool = False,
+                 on_flush: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+        self.csv_path = csv_path
+        self._chunk_rows = chunk_rows
+        self._on_flush = on_flush
+        self._buffer: List[Dict[str, Any]] = []
+        self.rows_written = 0
+
+        resume = append and os.path.exists(csv_path) and os.path.getsize(csv_path) > 0
+        # utf-8-sig would write a second BOM in the middle of a resumed file.
+        self._file = open(csv_path, "a" if resume else "w", newline="",
+                          encoding="utf-8" if resume else "utf-8-sig")
+        self._writer = csv.DictWriter(
+            self._file, fieldnames=self.COLUMNS, delimiter="\t", quoting=csv.QUOTE_ALL, extrasaction="ignore"
+        )
+        if not resume:
+            self._writer.writeheader()
+
+    def write(self, row: Dict[str, Any]):
+        """Buffers a result row, writing the buffer out once it reaches the chunk size."""
+        self._buffer.append(row)
+        if len(self._buffer) >= self._chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        self._writer.writerows(self._buffer)
+        self._file.flush()
+        self.rows_written += len(self._buffer)
+        if self._on_flush:
+            self._on_flush(self._buffer)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def export_excel(self, excel_path: str, chunk_rows: int = 5000):
+        """Builds an Excel workbook from the CSV file without loading it fully into memory."""
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(self.COLUMNS)
+        for chunk in pd.read_csv(
+            self.csv_path, sep="\t", encoding="utf-8-sig", dtype=str,
+            keep_default_na=False, chunksize=chunk_rows
+        ):
+            for values in chunk.itertuples(index=False, name=None):
+                sheet.append(list(values))
+        workbook.save(excel_path)
+        logging.info(f"Exported results to Excel: {excel_path}")
@@ -1,23 +1,87 @@
 import asyncio
+import contextlib
+import os
 import time
-from collections import deque
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextlib.contextmanager
+def _locked_file(path: str):
+    """Opens a file with an exclusive inter-process lock held for the duration of the block."""
+    with open(path, "a+b") as state_file:
+        if fcntl:
+            fcntl.flock(state_file.fileno(), fcntl.LOCK_EX)
+        else:
+            state_file.seek(0)
+            msvcrt.locking(state_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield state_file
+        finally:
+            if fcntl:
+                fcntl.flock(state_file.fileno(), fcntl.LOCK_UN)
+            else:
+                state_file.seek(0)
+                msvcrt.locking(state_file.fileno(), msvcrt.LK_UNLCK, 1)
+
 
 class RateLimiter:
-    """Limits the number of calls within a specific time period."""
-    def __init__(self, max_calls: int, period: int):
+    """
+    Limits the number of calls within a specific time period (GCRA).
+
+    The only state is the theoretical arrival time (TAT) of the next call. Callers reserve
+    their slot in FIFO order under a lock and then sleep outside it, so waiters wake one
+    at a time and the limit is never overshot. Up to `burst` calls may go through back to
+    back. With a state_file, the TAT is kept in a locked file so that several processes
+    share one budget.
+    """
+    def __init__(self, max_calls: int, period: int, burst: Optional[int] = None,
+                 state_file: Optional[str] = None):
         self.max_calls = max_calls
         self.period = period
-        self.calls = deque()
+        self.burst = max(1, burst or max_calls)
+        self._interval = period / max_calls
+        self._tolerance = self._interval * (self.burst - 1)
+        self._tat = 0.0
+        self._lock = asyncio.Lock()
+        self._state_file = state_file
+        if state_file:
+            os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+
+    def _reserve(self, now: float, tat: float) -> tuple:
+        """Returns the delay before the call may proceed and the updated TAT."""
+        tat = max(tat, now)
+        delay = max(0.0, tat - self._tolerance - now)
+        return delay, tat + self._interval
+
+    def _reserve_shared(self) -> float:
+        """Reserves a slot against the TAT stored in the state file (wall-clock based)."""
+        with _locked_file(self._state_file) as state_file:
+            state_file.seek(0)
+            try:
+                tat = float(state_file.read().decode() or 0.0)
+            except ValueError:
+                tat = 0.0
+            delay, tat = self._reserve(time.time(), tat)
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(repr(tat).encode())
+        return delay
 
     async def __aenter__(self):
-        while len(self.calls) >= self.max_calls:
-            elapsed = time.monotonic() - self.calls[0]
-            if elapsed < self.period:
-                await asyncio.sleep(self.period - elapsed)
+        async with self._lock:
+            if self._state_file:
+                delay = await asyncio.to_thread(self._reserve_shared)
             else:
-                self.calls.popleft()
-        self.calls.append(time.monotonic())
+                delay, self._tat = self._reserve(time.monotonic(), self._tat)
+        if delay > 0:
+            await asyncio.sleep(delay)
         return self
 
     async def __aexit__(self, exc_type, exc_val, tb):
-        pass 
\ No newline at end of file
+        pass
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+class ResponseCache:
+    """
+    Persistent on-disk cache of HTTP response bodies, keyed by normalized URL.
+
+    Entries live in a single SQLite file. Each entry has its own expiry time, and the
+    least recently used entries are evicted once the total body size exceeds max_bytes.
+    The database runs in WAL mode with synchronous=NORMAL, and access times of hits are
+    buffered in memory and written with the next store, every ACCESS_FLUSH_SIZE hits, or on close.
+    """
+    ACCESS_FLUSH_SIZE = 256
+
+    def __init__(self, path: str, ttl_seconds: int, max_bytes: int):
+        self._ttl_seconds = ttl_seconds
+        self._max_bytes = max_bytes
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._pending_access: Dict[str, float] = {}
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def normalize_url(url: str) -> str:
+        """Lower-cases scheme and host and sorts query parameters so equivalent URLs share a key."""
+        parts = urlsplit(url)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ""))
+
+    def _key(self, url: str) -> str:
+        return hashlib.sha256(self.normalize_url(url).encode("utf-8")).hexdigest()
+
+    def get(self, url: str) -> Optional[Tuple[int, Dict[str, str], bytes]]:
+        """Returns (status, headers, body) for a fresh entry, or None on a miss."""
+        key = self._key(url)
+        row = self._conn.execute(
+            "SELECT status, headers, body, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, headers, body, expires_at = row
+        now = time.time()
+        if expires_at < now:
+            self._delete(key)
+            return None
+        self._pending_access[key] = now
+        if len(self._pending_access) >= self.ACCESS_FLUSH_SIZE:
+            self._flush_access()
+            self._conn.commit()
+        return status, json.loads(headers), body
+
+    def put(self, url: str, status: int, headers: Dict[str, str], body: bytes,
+            ttl_seconds: Optional[int] = None):
+        """Stores a response, replacing any previous entry for the same URL."""
+        key = self._key(url)
+        now = time.time()
+        ttl = self._ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._pending_access.pop(key, None)
+        self._flush_access()
+        self._delete(key, commit=False)
+        self._conn.execute(
+            "INSERT INTO responses (key, url, status, headers, body, size, expires_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, url, status, json.dumps(headers), body, len(body), now + ttl, now)
+        )
+        self._total_bytes += len(body)
+        self._evict()
+        self._conn.commit()
+
+    def _flush_access(self):
+        """Writes buffered access times; the caller commits."""
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._pending_access.items()]
+            )
+            self._pending_access.clear()
+
+    def _delete(self, key: str, commit: bool = True):
+        self._pending_access.pop(key, None)
+        row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return
+        self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._total_bytes -= row[0]
+        if commit:
+            self._conn.commit()
+
+    def _evict(self):
+        """Drops expired entries, then least recently used ones, until under the size limit."""
+        if self._total_bytes <= self._max_bytes:
+            return
+        self._conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        evicted = 0
+        cursor = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access")
+        for key, size in cursor.fetchall():
+            if self._total_bytes <= self._max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._total_bytes -= size
+            evicted += 1
+        if evicted:
+            logging.info(f"Evicted {evicted} entries from the response cache.")
+
+    def close(self):
+        self._flush_access()
+        self._conn.commit()
+        self._conn.close()